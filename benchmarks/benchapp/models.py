@@ -0,0 +1,12 @@
+from django.db import models
+from django_native_search.models import IndexEntry
+
+
+class Document(models.Model):
+    title=models.CharField(max_length=255)
+    body=models.TextField()
+
+
+class DocumentIndexEntry(IndexEntry):
+    object=models.OneToOneField(Document, on_delete=models.CASCADE)
+    search_template="benchapp/document.txt"
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.humanize.templatetags.humanize import intcomma
-from .models import Lexem, Index
+from django.db.models import Avg, Count, Max
+from django.utils.html import format_html, format_html_join
+from .models import Lexem, Index, SearchLog
 
 @admin.register(Lexem)
 class LexemAdmin(admin.ModelAdmin):
@@ -10,8 +12,8 @@ class LexemAdmin(admin.ModelAdmin):
 
 @admin.register(Index)
 class IndexAdmin(admin.ModelAdmin):
-    readonly_fields = ['app_label', 'model', 'entries', 'occurrences']
-    list_display = ['__str__', 'entries', 'occurrences']
+    readonly_fields = ['app_label', 'model', 'entries', 'occurrences', 'slowest_searches']
+    list_display = ['__str__', 'entries', 'occurrences', 'slowest_search']
     
     def has_add_permission(self, request):
         return False
@@ -26,4 +28,37 @@ class IndexAdmin(admin.ModelAdmin):
         return intcomma(obj.entries())
     def occurrences(self, obj):
         return intcomma(obj.occurrences())
+    
+    def slowest_search(self, obj):
+        duration = obj.searches.aggregate(d=Max('duration'))['d']
+        return f"{duration*1000:.0f} ms" if duration is not None else "-"
+    
+    def slowest_searches(self, obj):
+        searches = obj.searches.values('query').annotate(
+            count=Count('*'), avg=Avg('duration'), max=Max('duration')).order_by('-max')[:10]
+        return format_html("<table><tr><th>Query</th><th>Count</th><th>Average</th><th>Max</th></tr>{}</table>",
+                           format_html_join("", "<tr><td>{}</td><td>{}</td><td>{} ms</td><td>{} ms</td></tr>",
+                                            ((s['query'], s['count'], round(s['avg']*1000), round(s['max']*1000)) 
+                                             for s in searches)))
+
+
+@admin.register(SearchLog)
+class SearchLogAdmin(admin.ModelAdmin):
+    list_display = ['query', 'index', 'duration_ms', 'queries', 'results', 'created']
+    list_filter = ['index']
+    search_fields = ['query']
+    ordering = ['-duration']
+    readonly_fields = ['index', 'query', 'duration_ms', 'queries', 'results', 'tokens', 'phases', 
+                       'explain', 'created']
+    exclude = ['duration']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    @admin.display(description='duration', ordering='duration')
+    def duration_ms(self, obj):
+        return f"{obj.duration*1000:.1f} ms"
         
\ No newline at end of file
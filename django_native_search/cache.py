@@ -0,0 +1,105 @@
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+
+RESULT_CACHE = getattr(settings, "SEARCH_RESULT_CACHE", None)
+RESULT_CACHE_TIMEOUT = getattr(settings, "SEARCH_RESULT_CACHE_TIMEOUT", 300)
+RESULT_CACHE_MAX_RESULTS = getattr(settings, "SEARCH_RESULT_CACHE_MAX_RESULTS", 10000)
+
+
+def get_result_cache():
+    return caches[RESULT_CACHE] if RESULT_CACHE else None
+
+
+def generation_key(model):
+    return f"search:generation:{model._meta.label_lower}"
+
+
+def get_generation(cache, model):
+    key=generation_key(model)
+    generation=cache.get(key)
+    if generation is None:
+        cache.add(key, time.time_ns(), None)
+        generation=cache.get(key)
+    return generation
+
+
+async def aget_generation(cache, model):
+    key=generation_key(model)
+    generation=await cache.aget(key)
+    if generation is None:
+        await cache.aadd(key, time.time_ns(), None)
+        generation=await cache.aget(key)
+    return generation
+
+
+def invalidate_results(model):
+    cache=get_result_cache()
+    if not cache:
+        return
+    for cls in [model, *model._meta.get_parent_list()]:
+        key=generation_key(cls)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+def query_digest(queryset, extra):
+    try:
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+    return hashlib.blake2b(repr((extra, sql, params)).encode(), digest_size=16).hexdigest()
+
+
+def make_key(kind, queryset, generation, digest):
+    return f"search:{kind}:{queryset.model._meta.label_lower}:{generation}:{queryset.db}:{digest}"
+
+
+def cache_key(cache, kind, queryset, *extra):
+    digest=query_digest(queryset, extra)
+    return digest and make_key(kind, queryset, get_generation(cache, queryset.model), digest)
+
+
+async def acache_key(cache, kind, queryset, *extra):
+    digest=query_digest(queryset, extra)
+    return digest and make_key(kind, queryset, await aget_generation(cache, queryset.model), digest)
+
+
+def result_tokens(conditions):
+    return [(str(c.token), c.token.lookup, getattr(c.token, 'sticky', False)) for c in conditions]
+
+
+def result_cache_key(cache, queryset, conditions, rank_by=None):
+    return cache_key(cache, "results", queryset, result_tokens(conditions), rank_by)
+
+
+async def aresult_cache_key(cache, queryset, conditions, rank_by=None):
+    return await acache_key(cache, "results", queryset, result_tokens(conditions), rank_by)
+
+
+def cached(queryset, kind, compute, *extra):
+    cache=get_result_cache()
+    key=cache and cache_key(cache, kind, queryset, *extra)
+    if not key:
+        return compute()
+    value=cache.get(key)
+    if value is None:
+        value=compute()
+        cache.set(key, value, RESULT_CACHE_TIMEOUT)
+    return value
+
+
+async def acached(queryset, kind, compute, *extra):
+    cache=get_result_cache()
+    key=cache and await acache_key(cache, kind, queryset, *extra)
+    if not key:
+        return await compute()
+    value=await cache.aget(key)
+    if value is None:
+        value=await compute()
+        await cache.aset(key, value, RESULT_CACHE_TIMEOUT)
+    return value
@@ -1,19 +1,63 @@
-from django.db import models
-from django.db.models.signals import post_save
+from collections import Counter
+from django.db import IntegrityError, connections, models, transaction
+
+from .manager import BULK_BATCH_SIZE, batches
+
+# The codes are stored in the database, new prefixes may only be appended.
+PREFIX_CODES = (' ', '', ', ', '. ', ': ', '; ', '! ', '? ', ' - ', '-', ' (', ') ', ' "', '" ', 
+                '", ', '." ', ' \'', '\' ', '/', '.', ',', "'", '"')
+PREFIXES = {prefix:code for code, prefix in enumerate(PREFIX_CODES)}
+
+
+def encode_prefix(prefix):
+    code=PREFIXES.get(prefix)
+    return (0, prefix) if code is None else (code, None)
+
+
+def decode_prefix(code, raw):
+    return PREFIX_CODES[code] if raw is None else raw
+
+
+def get_prefix(occurrence):
+    return decode_prefix(occurrence.prefix_code, occurrence.prefix_raw)
+
+
+def set_prefix(occurrence, prefix):
+    occurrence.prefix_code, occurrence.prefix_raw = encode_prefix(prefix)
+
+
+def through_accessor(remote_field):
+    class RelatedAccessor(remote_field.field.related_accessor_class):
+        
+        def __get__(self, instance, cls=None):
+            if instance:
+                return super().__get__(instance, cls)
+            
+            return self.rel.related_model._meta.default_manager
+    
+    return RelatedAccessor(remote_field)
+
 
 class OccurrencesField(models.ManyToManyField):
-    def __init__(self, query_name=None, **kwargs):
+    def __init__(self, query_name=None, compact=False, **kwargs):
         from .models import Lexem
         kwargs.setdefault('to', Lexem._meta.label)
         kwargs.setdefault('related_name','+')
         kwargs.setdefault('editable', False)
         super().__init__(**kwargs)
         self.query_name=query_name
+        self.compact=compact
         
     def deconstruct(self):
         name, path, args, kwargs = super().deconstruct()
         kwargs["query_name"]=self.query_name
+        if self.compact:
+            kwargs["compact"]=True
         return name, path, args, kwargs
+    
+    @property
+    def prefix_fields(self):
+        return ('prefix_code', 'prefix_raw') if self.compact else ('prefix',)
         
     def contribute_to_class(self, cls, name, **kwargs):
         super().contribute_to_class(cls, name, **kwargs)
@@ -24,8 +68,14 @@ class OccurrencesField(models.ManyToManyField):
         models.PositiveIntegerField(db_index=True).contribute_to_class(
             occurrences, 'position')
         
-        models.CharField(db_index=True, max_length=16, default=' ').contribute_to_class(
-            occurrences, 'prefix')
+        if self.compact:
+            models.PositiveSmallIntegerField(default=0).contribute_to_class(occurrences, 'prefix_code')
+            models.CharField(max_length=16, null=True, default=None).contribute_to_class(
+                occurrences, 'prefix_raw')
+            occurrences.prefix=property(get_prefix, set_prefix)
+        else:
+            models.CharField(db_index=True, max_length=16, default=' ').contribute_to_class(
+                occurrences, 'prefix')
         
         unique = occurrences._meta.unique_together[0]+('position',)
         occurrences._meta.unique_together=(unique,)
@@ -34,35 +84,191 @@ class OccurrencesField(models.ManyToManyField):
         occurrences._meta.verbose_name_plural=f"{cls._meta.model_name}-occurrences"
         remote_field=occurrences._meta.get_field(cls._meta.model_name).remote_field
         remote_field.related_query_name=self.query_name
+        setattr(cls, self.name, through_accessor(remote_field))
         
-        class RelatedAccessor(remote_field.field.related_accessor_class):
-            
-            def __get__(self, instance, cls=None):
-                if instance:
-                    return super().__get__(instance, cls)
-                
-                return self.rel.related_model._meta.default_manager
+    def update_occurrences(self, instance, created=False):
+        using=instance._state.db
+        connection=connections[using]
+        for attempt in range(2):
+            try:
+                with transaction.atomic(using=using):
+                    self.write_occurrences(instance, created)
+                    if connection.vendor=="postgresql":
+                        # Foreign keys are checked on commit, until then the resolved lexems can be 
+                        # collected as garbage. Checked now, the update can resolve them again.
+                        # SQLite serializes the writes, the entry saved before holds off the collection.
+                        connection.check_constraints()
+                return
+            except IntegrityError:
+                if attempt:
+                    raise
+    
+    def write_occurrences(self, instance, created=False):
+        from .statistics import update_statistics
+        occurrences=self.remote_field.through
+        entry_attname=occurrences._meta.get_field(self.m2m_field_name()).attname
+        lexem_attname=occurrences._meta.get_field(self.m2m_reverse_field_name()).attname
+        using=instance._state.db
         
-        setattr(cls, self.name, RelatedAccessor(remote_field))
+        if instance.storage=="postings":
+            from .postings import update_postings
+            update_postings(self.model, instance.pk, 
+                            self.resolve_rows(enumerate(instance.tokens), using), using)
+            return
         
-        post_save.connect(self.update_occurrences)
+        existing=occurrences._default_manager.using(using).filter(**{entry_attname:instance.pk})
+        streaming=getattr(instance, 'streaming', False)
+        tokens=enumerate(instance.iter_tokens())
+        pairs_field=get_pairs_field(self.model)
+        pairs=pairs_field and PairsWriter(pairs_field, instance, created)
+        old=Counter()
+        new=Counter()
+        last=-1
+        for batch in batches(tokens) if streaming else [list(tokens)]:
+            rows=self.resolve_rows(batch, using)
+            new.update(lexem for lexem, _ in rows.values())
+            if pairs and batch:
+                pairs.write([(position, lexem) for position, (lexem, _) in rows.items()], 
+                            batch[-1][0])
+            stale=set()
+            if not created:
+                window=existing
+                if streaming:
+                    window=existing.filter(position__gt=last, position__lte=batch[-1][0])
+                for position, lexem, *prefix in window.values_list('position', lexem_attname, 
+                                                                   *self.prefix_fields):
+                    prefix=decode_prefix(*prefix) if self.compact else prefix[0]
+                    old[lexem]+=1
+                    if rows.get(position)==(lexem, prefix):
+                        del rows[position]
+                    else:
+                        stale.add(position)
+            last=batch[-1][0] if batch else last
+            
+            for stale_batch in batches(stale):
+                existing.filter(position__in=stale_batch).delete()
+            occurrences._default_manager.using(using).bulk_create([
+                occurrences(**{entry_attname:instance.pk, lexem_attname:lexem, 
+                               'position':position, 'prefix':prefix})
+                for position, (lexem, prefix) in rows.items()], batch_size=BULK_BATCH_SIZE)
         
-    def update_occurrences(self, instance, **kwargs):
-        if not isinstance(instance, self.model):
-            return
+        if streaming and not created:
+            tail=existing.filter(position__gt=last)
+            old.update(dict(tail.values_list(lexem_attname).annotate(n=models.Count('pk')).order_by()))
+            tail.delete()
+        if pairs:
+            pairs.close()
+        update_statistics(self.model, old, new, using)
+    
+    def resolve_rows(self, tokens, using):
         lexem_model=self.remote_field.model
         max_length=lexem_model.surface.field.max_length
-        instance.occurrences.all().delete()
+        prefix_length=self.remote_field.through._meta.get_field(self.prefix_fields[-1]).max_length
+        tokens=[(position, surface) for position, surface in tokens if len(surface)<=max_length]
+        lexems=lexem_model._default_manager.db_manager(using).resolve(
+            set(surface for _, surface in tokens))
         
-        lexem_cache={}
-        for position, surface in enumerate(instance.tokens):
-            if len(surface)>max_length:
-                continue
-            
-            lexem=lexem_cache.get(surface) or lexem_cache.setdefault(
-                surface, lexem_model.objects.get_or_create(surface=surface)[0])
-            values=dict(lexem=lexem, position=position)
+        default_prefix=PREFIX_CODES[0]
+        rows={}
+        for position, surface in tokens:
             prefix=getattr(surface,'prefix',None)
-            if prefix is not None:
-                values['prefix']=prefix[:self.remote_field.through._meta.get_field('prefix').max_length]
-            instance.occurrences.create(**values)
+            prefix=default_prefix if prefix is None else prefix[:prefix_length]
+            rows[position]=(lexems[surface], prefix)
+        return rows
+
+
+class PairsField(models.ManyToManyField):
+    def __init__(self, **kwargs):
+        from .models import Lexem
+        kwargs.setdefault('to', Lexem._meta.label)
+        kwargs.setdefault('related_name','+')
+        kwargs.setdefault('editable', False)
+        super().__init__(**kwargs)
+    
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        pairs = self.remote_field.through
+        if not pairs or isinstance(pairs, str):
+            return
+        
+        # The following lexem is kept as a plain id, a second foreign key to the lexems 
+        # would make the relation ambiguous.
+        models.PositiveIntegerField(db_index=True).contribute_to_class(pairs, 'following')
+        models.PositiveIntegerField().contribute_to_class(pairs, 'position')
+        unique = pairs._meta.unique_together[0]+('position',)
+        pairs._meta.unique_together=(unique,)
+        pairs._meta.ordering=['position']
+        pairs._meta.verbose_name=f"{cls._meta.model_name}-pair"
+        pairs._meta.verbose_name_plural=f"{cls._meta.model_name}-pairs"
+        setattr(cls, self.name, through_accessor(
+            pairs._meta.get_field(cls._meta.model_name).remote_field))
+    
+    def update_pairs(self, instance, created=False):
+        """Rebuilds the pairs of an entry from its stored occurrences."""
+        if instance.storage=="postings":
+            return
+        occurrences=instance._meta.get_field('occurrences')
+        using=instance._state.db
+        words=occurrences.remote_field.through._default_manager.using(using).filter(
+            **{occurrences.m2m_field_name():instance.pk}).order_by('position').values_list(
+            'position', occurrences.m2m_reverse_field_name())
+        
+        with transaction.atomic(using=using):
+            pairs=PairsWriter(self, instance, created)
+            for batch in batches(words.iterator()):
+                pairs.write(batch, batch[-1][0])
+            pairs.close()
+
+
+class PairsWriter:
+    """Diffs the pairs of an entry window by window, as its words come in position order."""
+    
+    def __init__(self, field, instance, created=False):
+        self.pairs=field.remote_field.through
+        self.entry_attname=self.pairs._meta.get_field(field.m2m_field_name()).attname
+        self.lexem_attname=self.pairs._meta.get_field(field.m2m_reverse_field_name()).attname
+        self.instance=instance
+        self.created=created
+        self.previous=[]
+        self.paired=-1
+    
+    def write(self, words, last):
+        # The pair at the last position waits for the word following it.
+        words=self.previous+words
+        self.write_window(words, last-1)
+        self.paired=last-1
+        self.previous=words[-1:]
+    
+    def close(self):
+        self.write_window(self.previous, None)
+    
+    def write_window(self, words, last):
+        new={}
+        for (position, lexem), (following_position, following) in zip(words, words[1:]):
+            if following_position==position+1:
+                new[position]=(lexem, following)
+        
+        using=self.instance._state.db
+        existing=self.pairs._default_manager.using(using).filter(
+            **{self.entry_attname:self.instance.pk})
+        stale=[]
+        if not self.created:
+            window=existing.filter(position__gt=self.paired)
+            if last is not None:
+                window=window.filter(position__lte=last)
+            for position, lexem, following in window.values_list(
+                    'position', self.lexem_attname, 'following').iterator():
+                if new.get(position)==(lexem, following):
+                    del new[position]
+                else:
+                    stale.append(position)
+        for batch in batches(stale):
+            existing.filter(position__in=batch).delete()
+        self.pairs._default_manager.using(using).bulk_create([
+            self.pairs(**{self.entry_attname:self.instance.pk, self.lexem_attname:lexem, 
+                          'following':following, 'position':position})
+            for position, (lexem, following) in new.items()], batch_size=BULK_BATCH_SIZE)
+
+
+def get_pairs_field(model):
+    return next((field for field in model._meta.many_to_many if isinstance(field, PairsField)), None)
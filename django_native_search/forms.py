@@ -1,10 +1,15 @@
-from functools import partial, cache
+from functools import partial
 
+from asgiref.sync import sync_to_async
 from django import forms
+from django.core import signing
 from django.views.generic.edit import FormMixin
 from django.utils.text import capfirst
 from django.core.exceptions import ValidationError
 
+from .cache import cached
+from .manager import decode_cursor
+
 ALL_VALUE = "all"
 
 class SearchForm(forms.Form):
@@ -29,15 +34,34 @@ class SearchForm(forms.Form):
             raise ValidationError(f"'{query}' does not contain relevant keywords.")
         return query
     
-    def search(self):
+    def filtered_entries(self):
         filters = dict([(key if isinstance(val, str) else f"{key}__in", val) 
                         for key, val in self.cleaned_data.items()
                         if key != 'q' and val != ALL_VALUE])
-        
-        return self.index.objects.filter(**filters).search(self.cleaned_data["q"])
+        return self.index.objects.filter(**filters)
+    
+    def search(self):
+        return self.filtered_entries().search(self.cleaned_data["q"])
+    
+    async def asearch(self):
+        return await self.filtered_entries().asearch(self.cleaned_data["q"])
+    
+    def facets(self, results, fields):
+        return self.facet_choices(results.facets(*fields))
+    
+    async def afacets(self, results, fields):
+        return self.facet_choices(await results.afacets(*fields))
+    
+    def facet_choices(self, counts):
+        facets={}
+        for name, values in counts.items():
+            labels=dict(getattr(self.fields.get(name), 'choices', ()))
+            facets[name]=[(value, labels.get(value, value), count) for value, count in values]
+        return facets
 
 def field_values(field):
-    return field.model.objects.all().values_list(field.name, flat=True).distinct()
+    values=field.model._default_manager.all().values_list(field.name, flat=True).distinct()
+    return cached(values, "choices", lambda: list(values))
 
 def field_choice_gen(field, empty_label, all_label):
     if all_label:
@@ -97,13 +121,14 @@ class GetFormMixin(FormMixin):
         else:
             return self.form_invalid(form)
     
-    @cache
     def get_form(self):
-        form = super().get_form()
-        for f in form.fields.values():
-            if hasattr(f,'choices'):
-                f.choices=f.choices
-        return form
+        if not hasattr(self, '_form'):
+            form = super().get_form()
+            for f in form.fields.values():
+                if hasattr(f,'choices'):
+                    f.choices=list(f.choices)
+            self._form = form
+        return self._form
     
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
@@ -113,12 +138,54 @@ class GetFormMixin(FormMixin):
 
 class SearchFormMixin(GetFormMixin):
     results_per_page=25
+    cursor_param="cursor"
+    facet_fields=[]
     
     def get_context_data(self, form, **kwargs):
         context = super().get_context_data(**kwargs)
         if form.is_valid():
-            context['results'] = form.search().prefetch_matches()
+            results = self.get_results(form.search())
+            page = results.page(self.results_per_page, self.get_cursor())
+            page.count = results.count()
+            self.add_page_context(context, page)
+            if self.facet_fields:
+                context['facets'] = form.facets(results, self.facet_fields)
         return context
     
+    def get_results(self, results):
+        return results.prefetch_excerpts()
+    
+    def get_cursor(self):
+        cursor = self.request.GET.get(self.cursor_param)
+        try:
+            return cursor and decode_cursor(cursor)
+        except signing.BadSignature:
+            return None
+    
+    def add_page_context(self, context, page):
+        context['results'] = page
+        context['next_page'] = None
+        if page.next_cursor:
+            query = self.request.GET.copy()
+            query[self.cursor_param] = page.next_cursor
+            context['next_page'] = "?" + query.urlencode()
+    
     def form_valid(self, form):
         return self.render_to_response(self.get_context_data(form=form))
+
+
+class AsyncSearchFormMixin(SearchFormMixin):
+    async def get(self, request, *args, **kwargs):
+        form=await sync_to_async(self.get_form)()
+        return self.render_to_response(await self.aget_context_data(form=form, **kwargs))
+    
+    async def aget_context_data(self, form, **kwargs):
+        context = super(SearchFormMixin, self).get_context_data(form=form, **kwargs)
+        if form.is_valid():
+            results = self.get_results(await form.asearch())
+            page = await results.apage(self.results_per_page, self.get_cursor())
+            page.count = await results.acount()
+            self.add_page_context(context, page)
+            if self.facet_fields:
+                context['facets'] = await form.afacets(results, self.facet_fields)
+        return context
@@ -0,0 +1,236 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+from .manager import MAX_SUBSTR_MATCHES, NGRAM_SIZE
+
+LEXICON_PATH = getattr(settings, "SEARCH_LEXICON_PATH", None)
+LEXICON_REFRESH_INTERVAL = getattr(settings, "SEARCH_LEXICON_REFRESH_INTERVAL", 10)
+
+MAGIC = b"DNSLEX01"
+# Ids are assigned before commit, so lexems below the highest id may still appear later.
+GAP_WINDOW = 1000
+HEADER = struct.Struct("<8sqq")
+SEPARATOR = b"\n"
+# Sort orders of the snapshot, by surface, lowercase surface and normalized form.
+COLUMNS = ("surface", "lower", "normalized")
+LOOKUPS = {
+    "surface__exact": ("surface", "exact"),
+    "surface__startswith": ("surface", "prefix"),
+    "surface__contains": ("surface", "contains"),
+    "surface__lower__exact": ("lower", "exact"),
+    "surface__lower__startswith": ("lower", "prefix"),
+    "surface__lower__contains": ("lower", "contains"),
+    "normalized__exact": ("normalized", "exact"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def lexicon_path(using):
+    return LEXICON_PATH.format(database=using or DEFAULT_DB_ALIAS)
+
+
+def column_values(lexem, column):
+    surface, normalized = lexem[1], lexem[2]
+    return {"surface":surface, "lower":surface.lower(), "normalized":normalized}[column]
+
+
+def match(value, mode, text):
+    if mode=="exact":
+        return value==text
+    if mode=="prefix":
+        return value.startswith(text)
+    return text in value
+
+
+class Column:
+    def __init__(self, buffer, count, start):
+        self.buffer=buffer
+        self.ids=buffer[start:start+8*count].cast('q')
+        start+=8*count
+        self.offsets=buffer[start:start+8*(count+1)].cast('q')
+        self.start=start+8*(count+1)
+        self.end=self.start+self.offsets[-1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def value(self, i):
+        return bytes(self.buffer[self.start+self.offsets[i]:self.start+self.offsets[i+1]-1])
+
+    def lower_bound(self, key):
+        low, high = 0, len(self)
+        while low<high:
+            middle=(low+high)//2
+            if self.value(middle)<key:
+                low=middle+1
+            else:
+                high=middle
+        return low
+
+    def position(self, offset):
+        low, high = 0, len(self)
+        while low<high:
+            middle=(low+high)//2
+            if self.offsets[middle+1]<=offset:
+                low=middle+1
+            else:
+                high=middle
+        return low
+
+    def find(self, mode, text, data):
+        key=text.encode()
+        if mode=="exact":
+            return range(self.lower_bound(key), self.lower_bound(key+b"\0"))
+        if mode=="prefix":
+            # 0xff never occurs in UTF-8.
+            return range(self.lower_bound(key), self.lower_bound(key+b"\xff"))
+        found=[]
+        offset=data.find(key, self.start, self.end)
+        while offset>=0:
+            i=self.position(offset-self.start)
+            found.append(i)
+            offset=data.find(key, self.start+self.offsets[i+1], self.end)
+        return found
+
+
+class Lexicon:
+    """
+    Snapshot of the lexicon in a memory mapped file, resolving the keywords to lexem ids
+    in-process. Lexems created after the snapshot are loaded from the database.
+    """
+    def __init__(self, path, using=None):
+        self.path=path
+        self.using=using
+        self.lock=threading.Lock()
+        self.signature=None
+        self.checked=None
+        self.max_id=0
+        self.columns={}
+        self.recent=[]
+
+    def load(self):
+        try:
+            stat=os.stat(self.path)
+        except FileNotFoundError:
+            self.signature=None
+            self.columns={}
+            self.max_id=0
+            return
+        signature=(stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if signature==self.signature:
+            return
+        with open(self.path, 'rb') as f:
+            data=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.max_id = HEADER.unpack_from(data)
+        if magic!=MAGIC:
+            raise ValueError(f"{self.path} is not a lexicon file.")
+        self.data=data
+        buffer=memoryview(data)
+        start=HEADER.size
+        self.columns={}
+        for column in COLUMNS:
+            self.columns[column]=Column(buffer, count, start)
+            start=-(-self.columns[column].end//8)*8
+        self.signature=signature
+        logger.info(f"Loaded lexicon {self.path} with {count} lexems.")
+
+    def refresh(self):
+        from .models import Lexem
+        now=time.monotonic()
+        if self.checked is not None and now-self.checked<LEXICON_REFRESH_INTERVAL:
+            return
+        with self.lock:
+            if self.checked is not None and now-self.checked<LEXICON_REFRESH_INTERVAL:
+                return
+            self.load()
+            self.recent=list(Lexem.objects.using(self.using).filter(
+                pk__gt=max(self.max_id-GAP_WINDOW, 0)).values_list('pk', 'surface', 'normalized'))
+            self.checked=now
+
+    def resolve(self, lookups):
+        self.refresh()
+        if not self.columns:
+            return None
+        ids=set()
+        for lookup, text in lookups:
+            if lookup not in LOOKUPS:
+                return None
+            column_name, mode = LOOKUPS[lookup]
+            column=self.columns[column_name]
+            found=column.find(mode, str(text), self.data)
+            if mode=="contains" and len(found)>MAX_SUBSTR_MATCHES:
+                if len(text)>=NGRAM_SIZE:
+                    return None
+                found=sorted(found, key=lambda i: column.offsets[i+1]-column.offsets[i])[:MAX_SUBSTR_MATCHES]
+            ids.update(column.ids[i] for i in found)
+            ids.update(lexem[0] for lexem in self.recent
+                       if match(column_values(lexem, column_name), mode, text))
+        # A word may have been committed after the snapshot under an older id, the database decides.
+        return sorted(ids) or None
+
+
+lexicons = {}
+
+
+def get_lexicon(using=None):
+    if not LEXICON_PATH:
+        return None
+    path=lexicon_path(using)
+    if path not in lexicons:
+        lexicons[path]=Lexicon(path, using)
+    return lexicons[path]
+
+
+def read_lexems(path):
+    lexicon=Lexicon(path)
+    lexicon.load()
+    if not lexicon.columns:
+        return [], 0
+    surfaces=lexicon.columns["surface"]
+    normalized=lexicon.columns["normalized"]
+    forms={normalized.ids[i]:normalized.value(i).decode() for i in range(len(normalized))}
+    lexems=[(surfaces.ids[i], surfaces.value(i).decode(), forms[surfaces.ids[i]])
+            for i in range(len(surfaces))]
+    return lexems, lexicon.max_id
+
+
+def write_column(f, lexems, column):
+    values=sorted(((column_values(lexem, column).encode(), lexem[0]) for lexem in lexems))
+    offsets=array('q', [0])
+    for value, _ in values:
+        offsets.append(offsets[-1]+len(value)+1)
+    f.write(array('q', [pk for _, pk in values]).tobytes())
+    f.write(offsets.tobytes())
+    f.write(b"".join(value+SEPARATOR for value, _ in values))
+    f.write(b"\0"*(-offsets[-1]%8))
+
+
+def build_lexicon(using=None, full=False):
+    from .models import Lexem
+    if not LEXICON_PATH:
+        raise ImproperlyConfigured("SEARCH_LEXICON_PATH is not configured.")
+    path=lexicon_path(using)
+    lexems, max_id = ([], 0) if full else read_lexems(path)
+    lexems={lexem[0]:lexem for lexem in lexems}
+    lexems.update((lexem[0], lexem) for lexem in Lexem.objects.using(using).filter(
+        pk__gt=max(max_id-GAP_WINDOW, 0)).order_by('pk').values_list('pk', 'surface', 'normalized').iterator())
+    lexems=list(lexems.values())
+    max_id=max((lexem[0] for lexem in lexems), default=0)
+    temporary=f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(lexems), max_id))
+        for column in COLUMNS:
+            write_column(f, lexems, column)
+    os.replace(temporary, path)
+    logger.info(f"Built lexicon {path} with {len(lexems)} lexems.")
+    return len(lexems)
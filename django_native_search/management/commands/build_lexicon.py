@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from django_native_search.models import Lexem
+
+
+class Command(BaseCommand):
+    help = "Writes the lexicon snapshot file, which search processes map into memory to resolve keywords."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help="Database whose lexems are written.")
+        parser.add_argument('--full', action='store_true',
+                            help="Rewrite the snapshot from scratch instead of appending the new lexems.")
+
+    def handle(self, *args, database, full, **options):
+        count=Lexem.objects.db_manager(database).build_lexicon(full)
+        self.stdout.write(f"Wrote lexicon with {count} lexems.")
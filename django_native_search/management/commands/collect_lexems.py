@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from django_native_search.manager import BULK_BATCH_SIZE
+from django_native_search.models import Lexem
+
+
+class Command(BaseCommand):
+    help = "Deletes the lexems which do not occur in any index."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE,
+                            help="Number of lexems checked and deleted at once.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the unreferenced lexems.")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help="Database whose lexems are collected, e.g. one of the shards.")
+
+    def handle(self, *args, batch_size, dry_run, database, **options):
+        lexems=Lexem.objects.db_manager(database)
+        if dry_run:
+            self.stdout.write(f"Found {lexems.unreferenced().count()} of {lexems.count()} lexems unreferenced.")
+            return
+        collected=lexems.collect_garbage(batch_size)
+        self.stdout.write(f"Deleted {collected} unreferenced lexems, {lexems.count()} left.")
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_native_search.manager import QUEUE_BATCH_SIZE
+from django_native_search.models import IndexRequest
+
+
+class Command(BaseCommand):
+    help = "Updates the index entries of the objects queued for indexing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=QUEUE_BATCH_SIZE,
+                            help="Number of queued objects indexed at once.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep waiting for new objects when the queue is empty.")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="Seconds to wait for new objects in loop mode.")
+        parser.add_argument('--metrics', action='store_true',
+                            help="Print the number of pending objects and the queue lag and exit.")
+
+    def handle(self, *args, batch_size, loop, sleep, metrics, **options):
+        if metrics:
+            for index, values in IndexRequest.objects.metrics().items():
+                self.stdout.write(f"{index}: {values['pending']} pending, lag {values['lag']:.1f}s")
+            return
+
+        total=0
+        while True:
+            processed=IndexRequest.objects.process(batch_size)
+            total+=processed
+            if processed:
+                continue
+            if not loop:
+                break
+            time.sleep(sleep)
+        self.stdout.write(f"Indexed {total} queued objects.")
@@ -1,15 +1,40 @@
 import copy
+from itertools import islice
+from collections import defaultdict
+import time
+from datetime import timedelta
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import django
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.db import IntegrityError, connections, transaction
 from django.core.exceptions import FieldDoesNotExist
 from django.db.models import (F, Value, Min, Count, FloatField, QuerySet, Q, Prefetch,
-                              OuterRef, ExpressionWrapper)
+                              OuterRef, Exists, ExpressionWrapper)
 from django.db.models.manager import BaseManager, Manager
-from django.db.models.functions import Abs
+from django.db.models.functions import Abs, Length
 from django.conf import settings
 import logging
-from functools import cache
 from django.db.models.expressions import When, Case
+from django.db.models.query import ModelIterable
+from django.core import signing
+from django.utils import timezone
+
+from contextlib import nullcontext
+from .profiling import SearchProfile, PROFILING, PROFILE_EXPLAIN
+from .cache import (get_result_cache, result_cache_key, aresult_cache_key, cached, acached,
+                    RESULT_CACHE_TIMEOUT, RESULT_CACHE_MAX_RESULTS)
 
 MAX_RANKING_KEYWORDS = getattr(settings,"SEARCH_MAX_RANKING_KEYWORDS_COUNT", 3)
+BULK_BATCH_SIZE = getattr(settings, "SEARCH_BULK_BATCH_SIZE", 500)
+REBUILD_CHUNK_SIZE = getattr(settings, "SEARCH_REBUILD_CHUNK_SIZE", 1000)
+PLAN_QUERIES = getattr(settings, "SEARCH_PLAN_QUERIES", True)
+EXACT_COUNT_LIMIT = getattr(settings, "SEARCH_EXACT_COUNT_LIMIT", None)
+QUEUE_BATCH_SIZE = getattr(settings, "SEARCH_QUEUE_BATCH_SIZE", 100)
+QUEUE_LEASE = getattr(settings, "SEARCH_QUEUE_LEASE", 300)
+MAX_SUBSTR_MATCHES = 20000
+NGRAM_SIZE = 3
 
 logger=logging.getLogger(__name__)
 
@@ -22,14 +47,299 @@ def prefix_lookups(q, prefix):
     return q
 
 
+def refers_to_rank(lookups):
+    for lookup in lookups:
+        if isinstance(lookup, tuple):
+            lookup=lookup[0]
+        if isinstance(lookup, Q):
+            if refers_to_rank(lookup.children):
+                return True
+        elif isinstance(lookup, str) and lookup.split("__")[0]=="rank":
+            return True
+    return False
+
+
+def is_phrase_start(conditions, i):
+    return i+1<len(conditions) and getattr(conditions[i+1].token, 'sticky', False)
+
+
+def ranked_keywords(conditions, planned=None):
+    """Indexes of the conditions ranked by proximity: the phrases and the first keywords of the 
+    planned order, which are the rarest ones."""
+    planned=planned or conditions
+    ranked={id(condition) for i, condition in enumerate(planned) 
+            if i<MAX_RANKING_KEYWORDS-1 or getattr(condition.token, 'sticky', False) 
+            or is_phrase_start(planned, i)}
+    return {i for i, condition in enumerate(conditions) if id(condition) in ranked}
+
+
+def phrases(conditions):
+    start=None
+    for i, condition in enumerate(conditions+[None]):
+        if condition is not None and getattr(condition.token, 'sticky', False):
+            continue
+        if start is not None and i-start>1:
+            yield start, i
+        start=i
+
+
+def ngrams(surface):
+    surface=surface.lower()
+    return set(surface[i:i+NGRAM_SIZE] for i in range(len(surface)-NGRAM_SIZE+1))
+
+
+def batches(items, size=BULK_BATCH_SIZE):
+    items=iter(items)
+    while True:
+        batch=list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+class HitCount(int):
+    def __new__(cls, value, estimated=False):
+        count=super().__new__(cls, value)
+        count.exact=False
+        count.estimated=estimated
+        return count
+    
+    def __str__(self):
+        return f"~{int(self)}" if self.estimated else f"{int(self)}+"
+
+
+class ResultsPage(list):
+    def __init__(self, results, next_cursor=None, count=None):
+        super().__init__(results)
+        self.next_cursor=next_cursor
+        self.count=count
+
+
+def encode_cursor(entry):
+    position=[entry.rank, entry.pk]
+    if getattr(entry, 'shard', None) is not None:
+        position.append(entry.shard)
+    return signing.dumps(position, salt="search-cursor", compress=True)
+
+
+def decode_cursor(cursor):
+    return signing.loads(cursor, salt="search-cursor")
+
+
+def ranking_position(ranking, rank, pk=None):
+    low, high = 0, len(ranking)
+    while low<high:
+        middle=(low+high)//2
+        item_rank, item_pk = ranking[middle][1], ranking[middle][0]
+        if item_rank<rank or pk is not None and (item_rank, item_pk)<=(rank, pk):
+            low=middle+1
+        else:
+            high=middle
+    return low
+
+
+class LexemManager(Manager):
+    def resolve(self, surfaces):
+        surfaces=set(surfaces)
+        lexems={}
+        for batch in batches(surfaces):
+            lexems.update(self.filter(surface__in=batch).values_list('surface', 'pk'))
+        
+        missing=[surface for surface in surfaces if surface not in lexems]
+        if not missing:
+            return lexems
+        
+        from .normalizers import normalize
+        self.bulk_create([self.model(surface=surface, normalized=normalize(surface)) for surface in missing], 
+                         batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+        created={}
+        for batch in batches(missing):
+            created.update(self.filter(surface__in=batch).values_list('surface', 'pk'))
+        self.add_ngrams(created.items())
+        lexems.update(created)
+        return lexems
+    
+    def add_ngrams(self, lexems):
+        ngram_model=self.model.ngrams.rel.related_model
+        ngram_model._default_manager.using(self.db).bulk_create([
+            ngram_model(lexem_id=pk, gram=gram) 
+            for surface, pk in lexems for gram in ngrams(surface)],
+            batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+    
+    def rebuild_ngrams(self):
+        for batch in batches(self.values_list('surface', 'pk').iterator()):
+            self.add_ngrams(batch)
+    
+    def rebuild_normalized(self):
+        from .normalizers import normalize
+        updated=0
+        for batch in batches(self.only('pk', 'surface', 'normalized').order_by('pk').iterator()):
+            changed=[lexem for lexem in batch if lexem.normalized!=normalize(lexem.surface)]
+            for lexem in changed:
+                lexem.normalized=normalize(lexem.surface)
+            self.bulk_update(changed, ['normalized'])
+            updated+=len(changed)
+        return updated
+    
+    def unreferenced(self):
+        from .models import Index, PostingList
+        from .shadow import shadow_occurrences
+        references=set()
+        for model in Index.objects.indexentry_models:
+            if model._meta.abstract or model._meta.proxy:
+                continue
+            field=model._meta.get_field('occurrences')
+            references.add((field.remote_field.through, field.m2m_reverse_field_name()))
+            for through in shadow_occurrences(model, self.db):
+                references.add((through, field.m2m_reverse_field_name()))
+        qs=self.exclude(Exists(PostingList.objects.filter(lexem=OuterRef('pk'))))
+        for through, lexem_field in references:
+            qs=qs.exclude(Exists(through._default_manager.filter(**{lexem_field:OuterRef('pk')})))
+        return qs
+    
+    def collect_garbage(self, batch_size=BULK_BATCH_SIZE):
+        from .models import LexemNgram, LexemStatistics
+        connection=connections[self.db]
+        unreferenced=self.unreferenced()
+        collected=0
+        last=0
+        while True:
+            upper=self.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[batch_size-1:batch_size]
+            upper=next(iter(upper), None)
+            scanned=unreferenced.filter(pk__gt=last)
+            if upper is not None:
+                scanned=scanned.filter(pk__lte=upper)
+            # Deleted without cascading, a lexem referenced by occurrences committed since the scan 
+            # fails the foreign key check and the batch is left for the next collection.
+            try:
+                with transaction.atomic(using=self.db):
+                    garbage=list(scanned.select_for_update().values_list('pk', flat=True))
+                    if garbage:
+                        for model in (LexemNgram, LexemStatistics):
+                            model.objects.using(self.db).filter(lexem__in=garbage)._raw_delete(self.db)
+                        deleted=self.filter(pk__in=garbage)._raw_delete(self.db)
+                        if connection.vendor=="postgresql":
+                            connection.check_constraints()
+                        collected+=deleted
+            except IntegrityError:
+                logger.info(f"Lexems {garbage[0]}..{garbage[-1]} were referenced while collecting")
+            if upper is None:
+                break
+            last=upper
+        logger.info(f"Collected {collected} unreferenced lexems")
+        return collected
+    
+    def build_lexicon(self, full=False):
+        from .lexicon import build_lexicon
+        return build_lexicon(self.db, full)
+    
+    def containing(self, lookup, value):
+        grams=ngrams(value)
+        if not grams:
+            return self.filter(**{lookup:value}).order_by(Length("surface"))[:MAX_SUBSTR_MATCHES]
+        
+        ngram_model=self.model.ngrams.rel.related_model
+        candidates=ngram_model._default_manager.filter(gram__in=grams).values('lexem').annotate(
+            c=Count('*')).filter(c=len(grams)).values('lexem')
+        return self.filter(**{'pk__in':candidates, lookup:value})
+
+
 class SearchQuerySet(QuerySet):
     def __init__(self, model=None, query=None, using=None, hints=None):
         super().__init__(model=model, query=query, using=using, hints=hints)
         self.search_conditions=[]
+        self.ranking=None
+        self.ranking_exact=True
+        self.search_filtered=False
+        self.search_plan=None
+        self.profile=None
+        self._count=None
+        self.with_matches=False
+        self.with_excerpts=False
     
-    @cache
     def count(self):
-        return self.values('pk').aggregate(c=Count("*"))['c']
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._count is None:
+            with self.profiled("count"):
+                self._count=self.count_results()
+            if self.profile and not self.query.is_sliced:
+                self.profile.count=self._count
+        return self._count
+    
+    def count_results(self):
+        if self.ranking is not None:
+            if self.ranking_exact:
+                return len(self.ranking[self.query.low_mark:self.query.high_mark])
+            if self.query.is_sliced:
+                return len(self)
+            return self.unranked().count()
+        if EXACT_COUNT_LIMIT is None or not self.search_conditions or self.query.is_sliced:
+            return self.values('pk').aggregate(c=Count("*"))['c']
+        
+        count=self.values('pk')[:EXACT_COUNT_LIMIT+1].aggregate(c=Count("*"))['c']
+        if count<=EXACT_COUNT_LIMIT:
+            return count
+        # The statistics know nothing about other filters.
+        if self.search_filtered:
+            return HitCount(EXACT_COUNT_LIMIT)
+        from .statistics import estimate_total
+        estimate=estimate_total(self.model, self.search_conditions, self.db)
+        if estimate is not None:
+            estimate=min(estimate, self.model._base_manager.using(self.db).count())
+        if estimate is None or estimate<=EXACT_COUNT_LIMIT:
+            return HitCount(EXACT_COUNT_LIMIT)
+        return HitCount(estimate, estimated=True)
+    
+    def facet_matches(self):
+        qs=self._chain()
+        qs.query.clear_limits()
+        if qs.ranking is not None and qs.ranking_exact:
+            # A ranking from the result cache is counted by its pks, without searching again.
+            matched=[pk for pk, _ in qs.ranking]
+        else:
+            matched=qs.unranked().order_by().values('pk')
+        return self.model._default_manager.db_manager(self.db).filter(pk__in=matched)
+    
+    def facet_entries(self, matched, pks):
+        # Searched once for several fields, the values are grouped over the pks of the results.
+        if pks is not None and len(pks)<=RESULT_CACHE_MAX_RESULTS:
+            return self.model._default_manager.db_manager(self.db).filter(pk__in=pks)
+        return matched
+    
+    def facet_pks(self, matched, fields):
+        if len(fields)<2 or (self.ranking is not None and self.ranking_exact):
+            return None
+        return matched.values_list('pk', flat=True)[:RESULT_CACHE_MAX_RESULTS+1]
+    
+    def facet_values(self, matched, field):
+        return matched.values_list(field).annotate(n=Count('pk')).order_by('-n', field)
+    
+    def facets(self, *fields):
+        matched=self.facet_matches()
+        
+        def count_values():
+            pks=self.facet_pks(matched, fields)
+            entries=self.facet_entries(matched, pks if pks is None else list(pks))
+            return {field: list(self.facet_values(entries, field)) for field in fields}
+        with self.profiled("facets"):
+            return cached(matched, "facets", count_values, fields)
+    
+    async def afacets(self, *fields):
+        matched=self.facet_matches()
+        
+        async def count_values():
+            pks=self.facet_pks(matched, fields)
+            entries=self.facet_entries(matched, pks if pks is None else [pk async for pk in pks])
+            counts={}
+            for field in fields:
+                counts[field]=[values async for values in self.facet_values(entries, field)]
+            return counts
+        with self.profiled("facets"):
+            return await acached(matched, "facets", count_values, fields)
+    
+    def profiled(self, phase):
+        return self.profile.phase(phase, self.db) if self.profile else nullcontext()
         
     def apply_filter(self, q):
         filtered = self.filter(prefix_lookups(copy.deepcopy(q), "occurrence__"))
@@ -37,28 +347,189 @@ class SearchQuerySet(QuerySet):
         return filtered
     
     def search_one(self, condition):
-        return self.apply_filter(condition).distinct().annotate_rank().order_by("rank")
+        return self.apply_filter(condition).distinct().annotate_rank().order_by("rank", "pk")
     
-    def search(self, query):
-        ranking=self
-        filtered=self
-        conditions=self.model.parse_query(query)
+    def search(self, query, rank_by=None):
+        if self.model.shards and self._db is None:
+            from .sharding import ShardedResults
+            return ShardedResults.search(self, query, rank_by)
+        rank_by=self.ranking_method(rank_by)
+        qs=self
+        if PROFILING:
+            qs=self._chain()
+            qs.profile=SearchProfile(self.model, query)
+        
+        with qs.profiled("parse"):
+            conditions=self.model.parse_query(query, self.db)
+        if qs.profile:
+            qs.profile.tokens=[(str(c.token), c.token.lookup) for c in conditions]
+        
+        cache=get_result_cache()
+        with qs.profiled("cache"):
+            key=cache and conditions and result_cache_key(cache, qs, conditions, rank_by)
+            ranking=cache.get(key) if key else None
+        if isinstance(ranking, list):
+            results=qs.ranked(ranking, conditions)
+        else:
+            results=qs.apply_search(conditions, rank_by)
+            # False marks a query with too many results to cache, don't rank it twice.
+            if key and ranking is None:
+                with qs.profiled("rank"):
+                    ranking=results.ranking
+                    if ranking is None:
+                        ranking=list(results.values_list('pk', 'rank')[:RESULT_CACHE_MAX_RESULTS+1])
+                if len(ranking)<=RESULT_CACHE_MAX_RESULTS:
+                    cache.set(key, ranking, RESULT_CACHE_TIMEOUT)
+                    results=qs.ranked(ranking, conditions)
+                else:
+                    cache.set(key, False, RESULT_CACHE_TIMEOUT)
+        return self.searched(results)
+    
+    async def asearch(self, query, rank_by=None):
+        from .lexicon import get_lexicon
+        if (self.model.shards and self._db is None) or PROFILING:
+            # Sharded and profiled searches run in a thread.
+            return await sync_to_async(self.search)(query, rank_by)
+        rank_by=self.ranking_method(rank_by)
+        if get_lexicon(self.db):
+            # The lexicon loads the recently added lexems from the database.
+            conditions=await sync_to_async(self.model.parse_query)(query, self.db)
+        else:
+            conditions=self.model.parse_query(query, self.db)
+        
+        cache=get_result_cache()
+        key=cache and conditions and await aresult_cache_key(cache, self, conditions, rank_by)
+        ranking=await cache.aget(key) if key else None
+        if isinstance(ranking, list):
+            return self.searched(self.ranked(ranking, conditions))
+        results=await self.aapply_search(conditions, rank_by)
+        if key and ranking is None:
+            ranking=results.ranking
+            if ranking is None:
+                ranking=[row async for row in 
+                         results.values_list('pk', 'rank')[:RESULT_CACHE_MAX_RESULTS+1]]
+            if len(ranking)<=RESULT_CACHE_MAX_RESULTS:
+                await cache.aset(key, ranking, RESULT_CACHE_TIMEOUT)
+                results=self.ranked(ranking, conditions)
+            else:
+                await cache.aset(key, False, RESULT_CACHE_TIMEOUT)
+        return self.searched(results)
+    
+    def ranking_method(self, rank_by):
+        rank_by=rank_by or self.model.rank_by
+        if rank_by not in ("proximity", "bm25"):
+            raise ValueError(f"Unknown ranking '{rank_by}'.")
+        return rank_by
+    
+    def searched(self, results):
+        if results is self:
+            results=self._chain()
+        # Filters of the base queryset and the ones added from now on narrow the search.
+        results.search_filtered=bool(self.query.where)
+        return results
+    
+    def apply_search(self, conditions, rank_by="proximity"):
+        if len(conditions)<2 or not PLAN_QUERIES:
+            return self.rank(conditions, rank_by)
+        
+        with self.profiled("plan"):
+            planned, plan = self.plan_search(conditions)
+        logger.debug(f"Search plan for {self.model._meta.label}: {plan}")
+        if all(estimate for _, estimate in plan):
+            results=self.rank(conditions, rank_by, planned)
+        else:
+            results=self.none()
+            results.search_conditions=conditions
+        results.search_plan=plan
+        return results
+    
+    async def aapply_search(self, conditions, rank_by="proximity"):
+        from .statistics import aestimate_matches
+        if len(conditions)<2 or not PLAN_QUERIES:
+            return await self.arank(conditions, rank_by)
+        
+        planned, plan = self.plan_search(conditions, 
+                                         await aestimate_matches(self.model, conditions, self.db))
+        logger.debug(f"Search plan for {self.model._meta.label}: {plan}")
+        if all(estimate for _, estimate in plan):
+            results=await self.arank(conditions, rank_by, planned)
+        else:
+            results=self.none()
+            results.search_conditions=conditions
+        results.search_plan=plan
+        return results
+    
+    def plan_search(self, conditions, estimates=None):
+        from .statistics import estimate_matches
+        if estimates is None:
+            estimates=estimate_matches(self.model, conditions, self.db)
+        units=[]
+        for condition, estimate in zip(conditions, estimates):
+            if units and getattr(condition.token, 'sticky', False):
+                units[-1].append((condition, estimate))
+            else:
+                units.append([(condition, estimate)])
+        units.sort(key=lambda unit: min(estimate for _, estimate in unit))
+        planned=[item for unit in units for item in unit]
+        return [condition for condition, _ in planned], [(str(condition.token), estimate) 
+                                                         for condition, estimate in planned]
+    
+    def rank(self, conditions, rank_by="proximity", planned=None):
+        with self.profiled("rank"):
+            return self.apply_ranking(conditions, rank_by, planned)
+    
+    async def arank(self, conditions, rank_by="proximity", planned=None):
+        if conditions and (self.model.storage=="postings" or rank_by=="bm25"):
+            # The postings and the BM25 weights are loaded while ranking.
+            return await sync_to_async(self.rank)(conditions, rank_by, planned)
+        return self.rank(conditions, rank_by, planned)
+    
+    def apply_ranking(self, conditions, rank_by, planned=None):
+        if conditions and self.model.storage=="postings":
+            from .postings import search_postings
+            return search_postings(self, conditions, rank_by)
+        qs=self.filter_phrases(conditions)
+        if conditions and rank_by=="bm25":
+            return qs.rank_bm25(conditions, planned)
+        return qs.rank_proximity(conditions, planned)
+    
+    def filter_phrases(self, conditions):
+        from .fields import get_pairs_field
+        field=get_pairs_field(self.model)
+        if not field:
+            return self
+        pairs=field.remote_field.through._default_manager.db_manager(self.db)
+        entry, lexem = field.m2m_field_name(), f"{field.m2m_reverse_field_name()}__in"
+        
+        def probe(first, second, **kwargs):
+            return pairs.filter(**{lexem:first.lexems, 'following__in':second.lexems}, **kwargs)
+        
+        qs=self
+        for start, end in phrases(conditions):
+            if not all(hasattr(condition, 'lexems') for condition in conditions[start:end]):
+                continue
+            matched=probe(conditions[start], conditions[start+1])
+            for offset in range(1, end-start-1):
+                matched=matched.filter(Exists(probe(
+                    conditions[start+offset], conditions[start+offset+1], 
+                    **{entry:OuterRef(entry)}, position=OuterRef('position')+offset)))
+            qs=qs.filter(pk__in=matched.values(entry))
+        return qs
+    
+    def rank_proximity(self, conditions, planned=None):
         if len(conditions) == 1:
             return self.search_one(conditions[0])
         
+        # The planned order only speeds up filtering, the proximity depends on the query order.
+        filtered=self.filtered(planned or conditions)
+        ranking=self
         filter_by_ranking = False
+        # The proximity is measured between the ranked keywords, in the query order.
+        ranked = ranked_keywords(conditions, planned)
         for i, q in enumerate(conditions):
-            if filtered is not self:
-                filtered = self.filter(pk__in=filtered.all())
-            filtered = filtered.apply_filter(q)
-            
-            sticky = getattr(q.token,'sticky', None)
-            
-            if not sticky and i>=MAX_RANKING_KEYWORDS-1:
-                if filter_by_ranking:
-                    filtered = filtered.filter(pk__in=ranking.values("pk"))
-                ranking=filtered.carry_annotation(ranking, "rank")
+            if i not in ranked:
                 continue
+            sticky = getattr(q.token,'sticky', None)
             ranking=ranking.apply_filter(q).annotate_rank()
             if sticky:
                 ranking=ranking.filter(d=1)
@@ -73,7 +544,38 @@ class SearchQuerySet(QuerySet):
         results = self.filter(pk__in=filtered)
         results = results.carry_annotation(ranking, "rank")
         results.search_conditions=conditions
-        return results.order_by("rank")
+        return results.order_by("rank", "pk")
+    
+    def filtered(self, conditions):
+        filtered=self
+        for q in conditions:
+            if filtered is not self:
+                filtered=self.filter(pk__in=filtered.all())
+            filtered=filtered.apply_filter(q)
+        return filtered
+    
+    def matching(self, conditions, planned=None):
+        if any(getattr(q.token, 'sticky', False) for q in conditions):
+            return self.rank_proximity(conditions, planned).values("pk")
+        return self.filtered(planned or conditions).values("pk")
+    
+    def rank_bm25(self, conditions, planned=None):
+        from .statistics import bm25_weights, BM25_K1, BM25_B
+        average_length, weights = bm25_weights(self.model, conditions, self.db)
+        
+        results=self.filter(pk__in=self.matching(conditions, planned)).filter(prefix_lookups(
+            Q(*copy.deepcopy(conditions), _connector=Q.OR), "occurrence__"))
+        norm=Value(BM25_K1*(1-BM25_B))+Value(BM25_K1*BM25_B/average_length)*F("length")
+        score=Value(0.0)
+        for i, (q, weight) in enumerate(zip(conditions, weights)):
+            frequency=f"frequency{i}"
+            results=results.alias(**{frequency:Count("occurrence", 
+                filter=prefix_lookups(copy.deepcopy(q), "occurrence__"))})
+            score=score+Value(weight*(BM25_K1+1))*F(frequency)/(F(frequency)+norm)
+        
+        results=results.annotate(rank=ExpressionWrapper(-score, output_field=FloatField()))
+        results.search_conditions=conditions
+        return results.order_by("rank", "pk")
     
     def carry_annotation(self, qs, src, dst=None):
         return self.annotate(**{dst or src:qs.filter(pk=OuterRef("pk")).values(src)[:1]})
@@ -95,6 +597,11 @@ class SearchQuerySet(QuerySet):
         return ranking
 
     def prefetch_matches(self):
+        if self.model.storage=="postings":
+            qs=self._chain()
+            qs.with_matches=True
+            return qs
+        
         conditions=[]
         tokens=[]
         for condition in self.search_conditions:
@@ -112,9 +619,177 @@ class SearchQuerySet(QuerySet):
                                   queryset=qs,
                                   to_attr="matches"))
     
+    def prefetch_excerpts(self):
+        qs=self if self.has_prefetched_matches() else self.prefetch_matches()
+        qs=qs._chain()
+        qs.with_excerpts=True
+        return qs
+    
+    def has_prefetched_matches(self):
+        return self.with_matches or any(getattr(lookup, 'to_attr', None)=="matches" 
+                   for lookup in self._prefetch_related_lookups)
+    
+    def _prefetch_related_objects(self):
+        with self.profiled("matches"):
+            super()._prefetch_related_objects()
+            if self.with_matches:
+                from .postings import attach_matches
+                attach_matches(self._result_cache, self.search_conditions, self.db)
+        if self.with_excerpts:
+            with self.profiled("excerpts"):
+                self.model.prefetch_excerpts(self._result_cache)
+    
+    def after(self, cursor):
+        rank, pk, *_ = decode_cursor(cursor) if isinstance(cursor, str) else cursor
+        if self.ranking is None:
+            if pk is None:
+                return self.filter(rank__gte=rank)
+            return self.filter(Q(rank__gt=rank)|Q(rank=rank, pk__gt=pk))
+        qs=self._chain()
+        qs.ranking=self.ranking[ranking_position(self.ranking, rank, pk):]
+        return qs
+    
+    def page(self, size, cursor=None):
+        qs=self.after(cursor) if cursor else self
+        return qs.make_page(list(qs[:size+1]), size)
+    
+    async def apage(self, size, cursor=None):
+        qs=self.after(cursor) if cursor else self
+        return qs.make_page([entry async for entry in qs[:size+1]], size)
+    
+    def make_page(self, entries, size):
+        return ResultsPage(entries[:size], encode_cursor(entries[size-1]) if len(entries)>size else None)
+    
+    def ranked(self, ranking, conditions=None):
+        qs=self._chain()
+        qs.query.clear_ordering(force=True)
+        qs.ranking=ranking
+        qs.ranking_exact=True
+        if conditions is not None:
+            qs.search_conditions=conditions
+        return qs
+    
+    def user_ordered(self):
+        return bool(self.query.order_by) or not self.query.standard_ordering
+    
+    @property
+    def ordered(self):
+        return self.ranking is not None or super().ordered
+    
+    def unranked(self, ordered=False):
+        """Turns the ranking into a query, with the rank annotated and ordered by when ``ordered``."""
+        if self.ranking is None:
+            return self
+        qs=self._chain()
+        qs.ranking=None
+        low, high = qs.query.low_mark, qs.query.high_mark
+        ranking=self.ranking
+        if self.ranking_exact and not self.user_ordered():
+            ranking, low, high = ranking[low:high], 0, None
+        qs.query.clear_limits()
+        qs=qs.filter(pk__in=[pk for pk, _ in ranking])
+        if ordered:
+            qs=qs.annotate(rank=Case(*[When(pk=pk, then=Value(rank)) for pk, rank in ranking],
+                                     output_field=FloatField()))
+            if not qs.query.order_by:
+                qs=qs.order_by("rank", "pk")
+        qs.search_filtered=self.search_filtered
+        qs.query.set_limits(low, high)
+        return qs
+    
+    def iter_ranking(self):
+        base=self._chain()
+        base.ranking=None
+        base.profile=None
+        base._prefetch_related_lookups=()
+        base.with_matches=base.with_excerpts=False
+        base.query.clear_limits()
+        base.query.clear_ordering(force=True)
+        
+        low, high = self.query.low_mark, self.query.high_mark
+        ranking=self.ranking
+        if self.ranking_exact:
+            ranking, low, high = ranking[low:high], 0, None
+        
+        matched=0
+        for batch in batches(ranking):
+            objects=base.in_bulk([pk for pk, _ in batch])
+            for pk, rank in batch:
+                obj=objects.get(pk)
+                if obj is None:
+                    continue
+                matched+=1
+                if matched<=low:
+                    continue
+                obj.rank=rank
+                yield obj
+                if high is not None and matched>=high:
+                    return
+    
+    def _fetch_all(self):
+        if self._result_cache is not None:
+            return super()._fetch_all()
+        if self.ranking is not None and (self._iterable_class is not ModelIterable
+                                         or self.user_ordered()):
+            self._result_cache=list(self.unranked(ordered=True))
+            self._prefetch_done=True
+            return
+        if self._iterable_class is not ModelIterable:
+            return super()._fetch_all()
+        
+        if (self.profile and PROFILE_EXPLAIN and self.ranking is None and not self.profile.explain
+                and not self.query.is_empty()):
+            self.profile.explain=self.explain()
+        with self.profiled("fetch"):
+            if self.ranking is None:
+                super()._fetch_all()
+            else:
+                self._result_cache=list(self.iter_ranking())
+            if not self._prefetch_done:
+                self._prefetch_related_objects()
+            self._prefetch_done=True
+        if self.profile:
+            self.profile.results=len(self._result_cache)
+            self.profile.emit()
+    
+    def _filter_or_exclude(self, negate, args, kwargs):
+        if self.ranking is not None and refers_to_rank([*args, *kwargs]):
+            return self.unranked(ordered=True)._filter_or_exclude(negate, args, kwargs)
+        clone=super()._filter_or_exclude(negate, args, kwargs)
+        clone.ranking_exact=self.ranking is None
+        clone.search_filtered=True
+        return clone
+    
+    def exists(self):
+        if self.ranking is not None and self._result_cache is None:
+            return self.unranked().exists()
+        return super().exists()
+    
+    def aggregate(self, *args, **kwargs):
+        return super(SearchQuerySet, self.unranked()).aggregate(*args, **kwargs)
+    
+    def iterator(self, *args, **kwargs):
+        return super(SearchQuerySet, self.unranked(ordered=True)).iterator(*args, **kwargs)
+    
+    def resolve_expression(self, *args, **kwargs):
+        return super(SearchQuerySet, self.unranked()).resolve_expression(*args, **kwargs)
+    
+    def _values(self, *fields, **expressions):
+        return super(SearchQuerySet, self.unranked(ordered=True))._values(*fields, **expressions)
+    
+    def _annotate(self, args, kwargs, select=True):
+        return super(SearchQuerySet, self.unranked(ordered=True))._annotate(args, kwargs, select)
+    
     def _clone(self):
         c = super()._clone()
         c.search_conditions=self.search_conditions[:]
+        c.ranking=self.ranking
+        c.ranking_exact=self.ranking_exact
+        c.search_filtered=self.search_filtered
+        c.search_plan=self.search_plan
+        c.profile=self.profile
+        c.with_matches=self.with_matches
+        c.with_excerpts=self.with_excerpts
         return c
 
 class IndexManager(Manager):
@@ -159,7 +834,8 @@ class IndexEntryManager(BaseManager.from_queryset(SearchQuerySet)):
         if not model:
             raise RuntimeError(f"Index for {obj._meta.model_name} is not configured.")
         try:
-            indexed=model._meta.default_manager.get(**{model.object_field:obj})
+            indexed=model._meta.default_manager.db_manager(model.shard_for(obj.pk)).get(
+                **{model.object_field:obj})
             setattr(indexed,model.object_field, obj)
             return indexed
         except model.DoesNotExist:
@@ -175,7 +851,21 @@ class IndexEntryManager(BaseManager.from_queryset(SearchQuerySet)):
                 return index
         return None
     
-    def refresh(self, objects, break_on_failure=False):
+    def refresh(self, objects=None, break_on_failure=False, since=None):
+        if objects is None:
+            if not self.target_model:
+                failed=[]
+                for subcls in self.model.__subclasses__():
+                    failed+=subcls._meta.default_manager.refresh(None, break_on_failure, since)
+                return failed
+            objects=self.model.get_index_queryset()
+        
+        if since is not None:
+            if not self.model.modified_field:
+                raise RuntimeError(f"Modification field of {self.model._meta.label} is not configured.")
+            objects=objects.filter(**{f"{self.model.modified_field}__gt":since})
+        
+        failed=[]
         for obj in objects:
             try:
                 self.get_or_prepare(obj).save()
@@ -183,12 +873,216 @@ class IndexEntryManager(BaseManager.from_queryset(SearchQuerySet)):
                 logger.exception(f"Exception raised when updating index for '{obj}'")
                 if break_on_failure:
                     raise
+                failed.append(obj)
+        return failed
     
-    def rebuild(self):
+    def enqueue(self, objects):
+        from .models import IndexRequest
+        by_model=defaultdict(list)
+        for obj in objects:
+            model=self.get_index_model(obj._meta.model)
+            if not model:
+                raise RuntimeError(f"Index for {obj._meta.model_name} is not configured.")
+            by_model[model].append(obj)
+        for model, objs in by_model.items():
+            IndexRequest.objects.db_manager(self.db).enqueue(model, objs)
+    
+    def rebuild(self, chunk_size=None, processes=None, resume=False, progress=None, online=False):
         if self.target_model:
-            return self.refresh(self.model.get_index_queryset())
+            if online:
+                return self.rebuild_online(chunk_size or REBUILD_CHUNK_SIZE, processes or 1, progress)
+            if self.model.shards and not (processes or resume):
+                from .sharding import rebuild_shards
+                return rebuild_shards(self.model, chunk_size or REBUILD_CHUNK_SIZE)
+            if not (chunk_size or processes or resume):
+                return self.refresh(self.model.get_index_queryset())
+            return self.rebuild_chunked(chunk_size or REBUILD_CHUNK_SIZE, processes or 1, 
+                                        resume, progress)
             
         for subcls in self.model.__subclasses__():
-            subcls._meta.default_manager.rebuild()
-            
+            subcls._meta.default_manager.rebuild(chunk_size, processes, resume, progress, online)
+    
+    def rebuild_pairs(self):
+        from .fields import get_pairs_field
+        field=get_pairs_field(self.model)
+        if not field:
+            raise RuntimeError(f"Pairs of {self.model._meta.label} are not configured.")
+        for entry in self.all().iterator():
+            field.update_pairs(entry)
+    
+    def rebuild_statistics(self):
+        from .statistics import rebuild_statistics
+        for using in (self.model.shards if self.model.shards and self._db is None else [self.db]):
+            rebuild_statistics(self.model, using)
+    
+    def rebuild_online(self, chunk_size=REBUILD_CHUNK_SIZE, processes=1, progress=None):
+        from .shadow import ShadowTables
+        shadow=ShadowTables(self.model)
+        shadow.check()
+        started=timezone.now()
+        shadow.create()
+        try:
+            with shadow.activate():
+                self.rebuild_chunked(chunk_size, processes, False, progress, shadow.suffix)
+            shadow.swap(started)
+        except BaseException:
+            shadow.drop(shadow.tables("s"))
+            raise
+        return shadow.drop_old()
+    
+    def rebuild_chunked(self, chunk_size, processes, resume, progress, shadow=None):
+        queryset=self.model.get_index_queryset()
+        stats=RebuildProgress(self.model, queryset.count(), resume, progress)
+        chunks=self.iter_chunks(queryset, chunk_size, stats.completed_chunks())
+        
+        if processes<=1:
+            for after, last in chunks:
+                stats.update(after, last, rebuild_chunk(self.model._meta.label, after, last, shadow))
+        else:
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=processes, 
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=django.setup) as executor:
+                pending={}
+                for after, last in chunks:
+                    if len(pending)>=processes*2:
+                        self.wait_for_chunks(pending, stats)
+                    future=executor.submit(rebuild_chunk, self.model._meta.label, after, last, shadow)
+                    pending[future]=(after, last)
+                while pending:
+                    self.wait_for_chunks(pending, stats)
+        stats.finish()
+    
+    def wait_for_chunks(self, pending, stats):
+        completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in completed:
+            after, last = pending.pop(future)
+            stats.update(after, last, future.result())
+    
+    def iter_chunks(self, queryset, chunk_size, done):
+        pk=self.target_model._meta.pk
+        after=None
+        while True:
+            if after in done:
+                after=done[after]
+                continue
+            chunk=queryset.order_by('pk')
+            if after is not None:
+                chunk=chunk.filter(pk__gt=pk.to_python(after))
+            pks=list(chunk.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return
+            last=str(pks[-1])
+            yield after, last
+            after=last
+
+
+class IndexRequestManager(Manager):
+    def enqueue(self, model, objects):
+        from django.contrib.contenttypes.models import ContentType
+        index=ContentType.objects.get_for_model(model)
+        now=timezone.now()
+        for batch in batches(objects):
+            object_ids=[str(obj.pk) for obj in batch]
+            self.filter(index=index, object_id__in=object_ids).update(updated=now)
+            self.bulk_create([self.model(index=index, object_id=object_id, requested=now, updated=now)
+                              for object_id in object_ids], ignore_conflicts=True)
+    
+    def process(self, batch_size=QUEUE_BATCH_SIZE):
+        from django.contrib.contenttypes.models import ContentType
+        started=timezone.now()
+        # The requests are claimed by leasing them in a short transaction, so the rows are not locked 
+        # while indexing. The requests of a worker that died are processed again after the lease.
+        with transaction.atomic(using=self.db):
+            queue=self.filter(requested__lte=started).order_by('requested')
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                queue=queue.select_for_update(skip_locked=True)
+            requests=list(queue.values_list('pk', 'index', 'object_id')[:batch_size])
+            self.filter(pk__in=[pk for pk, _, _ in requests]).update(
+                requested=started+timedelta(seconds=QUEUE_LEASE))
+        
+        object_ids=defaultdict(list)
+        for _, index, object_id in requests:
+            object_ids[index].append(object_id)
+        failed=set()
+        for index, ids in object_ids.items():
+            model=ContentType.objects.db_manager(self.db).get_for_id(index).model_class()
+            if model:
+                failed.update((index, str(obj.pk)) for obj in model._meta.default_manager.refresh(
+                    model.get_index_queryset().filter(pk__in=ids)))
+        
+        # Failed requests stay leased and are retried after the lease.
+        done=[pk for pk, index, object_id in requests if (index, object_id) not in failed]
+        self.filter(pk__in=done, updated__lte=started).delete()
+        # Requested again while being indexed.
+        self.filter(pk__in=done).update(requested=started)
+        if failed:
+            logger.warning(f"Indexing of {len(failed)} queued objects failed, "
+                           f"retrying in {QUEUE_LEASE} seconds")
+        if requests:
+            logger.info(f"Indexed {len(requests)-len(failed)} queued objects, {self.metrics()}")
+        return len(requests)
+    
+    def metrics(self):
+        from django.contrib.contenttypes.models import ContentType
+        now=timezone.now()
+        metrics={}
+        for index, pending, oldest in self.values_list('index').annotate(
+                pending=Count('*'), oldest=Min('requested')).order_by():
+            model=ContentType.objects.db_manager(self.db).get_for_id(index)
+            # Leased requests are dated in the future.
+            metrics[str(model)]={'pending':pending, 'lag':max((now-oldest).total_seconds(), 0)}
+        return metrics
+
+
+def rebuild_chunk(label, after, last, shadow=None):
+    model=apps.get_model(label)
+    manager=model._meta.default_manager
+    pk=manager.target_model._meta.pk
+    queryset=model.get_index_queryset().order_by('pk').filter(pk__lte=pk.to_python(last))
+    if after is not None:
+        queryset=queryset.filter(pk__gt=pk.to_python(after))
+    objects=list(queryset)
+    from .shadow import ShadowTables, shadowing
+    if shadow and not shadowing(model):
+        with ShadowTables(model, shadow).activate():
+            manager.refresh(objects)
+    else:
+        manager.refresh(objects)
+    return len(objects)
+
+
+class RebuildProgress:
+    def __init__(self, model, total, resume=False, callback=None):
+        from .models import RebuildCheckpoint
+        from django.contrib.contenttypes.models import ContentType
+        self.model=model
+        self.index=ContentType.objects.get_for_model(model)
+        self.checkpoints=RebuildCheckpoint.objects.filter(index=self.index)
+        if not resume:
+            self.checkpoints.delete()
+        self.total=total
+        self.done=sum(self.checkpoints.values_list('count', flat=True))
+        self.indexed=0
+        self.callback=callback
+        self.started=time.monotonic()
+    
+    def completed_chunks(self):
+        return dict(self.checkpoints.values_list('after', 'last'))
+    
+    @property
+    def rate(self):
+        elapsed=time.monotonic()-self.started
+        return self.indexed/elapsed if elapsed else 0.0
+    
+    def update(self, after, last, count):
+        self.checkpoints.model.objects.create(index=self.index, after=after, last=last, count=count)
+        self.done+=count
+        self.indexed+=count
+        logger.info(f"Rebuilding {self.model._meta.label}: {self.done}/{self.total} "
+                    f"({self.rate:.1f} rows/s)")
+        if self.callback:
+            self.callback(self)
     
+    def finish(self):
+        self.checkpoints.delete()
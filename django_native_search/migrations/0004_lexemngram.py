@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django_native_search.manager import batches, ngrams
+
+
+def add_lexem_ngrams(apps, schema_editor):
+    Lexem = apps.get_model('django_native_search', 'Lexem')
+    LexemNgram = apps.get_model('django_native_search', 'LexemNgram')
+    using = schema_editor.connection.alias
+    lexems = Lexem.objects.using(using).values_list('surface', 'pk').iterator()
+    for batch in batches(lexems):
+        LexemNgram.objects.using(using).bulk_create([
+            LexemNgram(lexem_id=pk, gram=gram) for surface, pk in batch for gram in ngrams(surface)],
+            ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_native_search', '0003_rebuildcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LexemNgram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('lexem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ngrams', related_query_name='ngram', to='django_native_search.lexem')),
+            ],
+            options={
+                'unique_together': {('gram', 'lexem')},
+            },
+        ),
+        migrations.DeleteModel(
+            name='LexemTail',
+        ),
+        migrations.RunPython(add_lexem_ngrams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_native_search', '0004_lexemngram'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostingDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('index', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_native_search.index')),
+            ],
+            options={
+                'unique_together': {('index', 'entry')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PostingList',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('block', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('index', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_native_search.index')),
+                ('lexem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_native_search.lexem')),
+            ],
+            options={
+                'unique_together': {('index', 'lexem', 'block')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_native_search', '0005_postings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexStatistics',
+            fields=[
+                ('index', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='statistics', serialize=False, to='django_native_search.index')),
+                ('documents', models.IntegerField(default=0)),
+                ('length', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'index statistics',
+            },
+        ),
+        migrations.CreateModel(
+            name='LexemStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('documents', models.IntegerField(default=0)),
+                ('index', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_native_search.index')),
+                ('lexem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='django_native_search.lexem')),
+            ],
+            options={
+                'verbose_name_plural': 'lexem statistics',
+                'unique_together': {('index', 'lexem')},
+            },
+        ),
+    ]
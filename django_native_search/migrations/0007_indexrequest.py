@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_native_search', '0006_statistics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=255)),
+                ('requested', models.DateTimeField(db_index=True)),
+                ('updated', models.DateTimeField()),
+                ('index', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='requests', to='django_native_search.index')),
+            ],
+            options={
+                'unique_together': {('index', 'object_id')},
+            },
+        ),
+    ]
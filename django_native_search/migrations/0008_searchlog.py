@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_native_search', '0007_indexrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=255)),
+                ('duration', models.FloatField(db_index=True)),
+                ('queries', models.PositiveIntegerField()),
+                ('results', models.PositiveIntegerField(null=True)),
+                ('phases', models.JSONField(default=dict)),
+                ('tokens', models.JSONField(default=list)),
+                ('explain', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('index', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='searches', to='django_native_search.index')),
+            ],
+        ),
+    ]
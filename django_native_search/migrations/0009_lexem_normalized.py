@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:10
+
+from django.db import migrations, models
+from django_native_search.manager import batches
+from django_native_search.normalizers import normalize
+
+
+def normalize_lexems(apps, schema_editor):
+    Lexem = apps.get_model('django_native_search', 'Lexem')
+    lexems = Lexem.objects.using(schema_editor.connection.alias)
+    for batch in batches(lexems.only('pk', 'surface').order_by('pk').iterator()):
+        for lexem in batch:
+            lexem.normalized = normalize(lexem.surface)
+        lexems.bulk_update(batch, ['normalized'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_native_search', '0008_searchlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lexem',
+            name='normalized',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.RunPython(normalize_lexems, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 from django.db import migrations
-from django_native_search.fields import OccurrencesField
+from django.db.models import Case, F, Value, When
+from django_native_search.fields import OccurrencesField, PREFIX_CODES
 
 class OccurrencesAddPrefixField(migrations.AlterField):
     def __init__(self, model_name):
@@ -12,3 +13,44 @@ class OccurrencesAddPrefixField(migrations.AlterField):
         from_field = from_model._meta.get_field(self.name)
         through=from_field.remote_field.through
         schema_editor.add_field(through, through._meta.get_field('prefix'))
+
+
+class OccurrencesCompactPrefix(migrations.AlterField):
+    def __init__(self, model_name, compact=True):
+        super().__init__(model_name=model_name,
+            name='occurrences',
+            field=OccurrencesField(query_name="occurrence", compact=compact))
+        self.compact=compact
+    
+    def deconstruct(self):
+        return self.__class__.__name__, [], {'model_name':self.model_name, 'compact':self.compact}
+    
+    def describe(self):
+        layout="compact" if self.compact else "plain"
+        return f"Convert occurrences of {self.model_name} to {layout} prefixes"
+    
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        from_field=from_state.apps.get_model(app_label, self.model_name)._meta.get_field(self.name)
+        to_field=to_state.apps.get_model(app_label, self.model_name)._meta.get_field(self.name)
+        if from_field.compact==to_field.compact:
+            return
+        through=from_field.remote_field.through
+        for name in to_field.prefix_fields:
+            field=to_field.remote_field.through._meta.get_field(name).clone()
+            field.set_attributes_from_name(name)
+            schema_editor.add_field(through, field)
+            field.contribute_to_class(through, name)
+        
+        occurrences=through._default_manager.using(schema_editor.connection.alias)
+        if to_field.compact:
+            occurrences.update(
+                prefix_code=Case(*[When(prefix=prefix, then=Value(code)) for code, prefix in enumerate(PREFIX_CODES)],
+                                 default=Value(0)),
+                prefix_raw=Case(When(prefix__in=PREFIX_CODES, then=Value(None)), default=F('prefix')))
+        else:
+            occurrences.filter(prefix_raw__isnull=False).update(prefix=F('prefix_raw'))
+            for code, prefix in enumerate(PREFIX_CODES):
+                occurrences.filter(prefix_raw__isnull=True, prefix_code=code).update(prefix=Value(prefix))
+        
+        for name in from_field.prefix_fields:
+            schema_editor.remove_field(through, through._meta.get_field(name))
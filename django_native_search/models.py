@@ -1,19 +1,31 @@
+import hashlib
 import logging
+from collections import Counter, defaultdict
 import re
+import zlib
+from functools import partial
 from html import escape
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.db.models.functions import Lower
+from django.db.models.signals import class_prepared, post_delete, pre_delete
 import django_expression_index
 
-from django.template.loader import render_to_string
+from asgiref.sync import sync_to_async
+from django.template.context import make_context
+from django.template.loader import get_template, render_to_string
 from django.utils.functional import cached_property
 
-from .manager import IndexEntryManager, IndexManager
+from .manager import (IndexEntryManager, IndexManager, IndexRequestManager, LexemManager, 
+                      NGRAM_SIZE, batches)
 from django.utils.safestring import mark_safe
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django_native_search.fields import OccurrencesField
-from django.db.models.functions.text import Length
+from .cache import invalidate_results
+from .lexicon import get_lexicon
+from .normalizers import normalize
+from .profiling import SLOW_SEARCH_THRESHOLD
+from .signals import search_profiled
 
 
 MIN_SUBSTR_LEN=getattr(settings,"SEARCH_MIN_SUBSTR_LENGTH", 2)
@@ -21,11 +33,17 @@ MAX_EXCERPT_FRAGMENTS=getattr(settings, "SEARCH_MAX_EXCERPT_FRAGMENTS", 5)
 EXCERPT_FRAGMENT_START_OFFSET=getattr(settings, "SEARCH_EXCERPT_FRAGMENT_START_OFFSET", -3)
 EXCERPT_FRAGMENT_END_OFFSET=getattr(settings, "SEARCH_EXCERPT_FRAGMENT_END_OFFSET", 6)
 EXCERPT_ADDITONAL_CONTEXT_FACTOR=getattr(settings, "SEARCH_EXCERPT_ADDITONAL_CONTEXT_FACTOR", 2)
+EXCERPT_BATCH_SIZE=50
+STREAM_CHUNK_SIZE=getattr(settings, "SEARCH_STREAM_CHUNK_SIZE", 65536)
+WHITESPACE=re.compile(r"\s+")
 
 logger=logging.getLogger(__name__)
 
 class Lexem(models.Model):
     surface=models.CharField(max_length=255, db_index=True, unique=True)
+    normalized=models.CharField(max_length=255, db_index=True, default='')
+    
+    objects=LexemManager()
     
     class Meta:
         indexes=[django_expression_index.ExpressionIndex(expressions=[Lower('surface')])]
@@ -34,16 +52,36 @@ class Lexem(models.Model):
         return self.surface
 
 
+class LexemNgram(models.Model):
+    lexem=models.ForeignKey(Lexem, on_delete=models.CASCADE, 
+                            related_name='ngrams', related_query_name='ngram')
+    gram=models.CharField(max_length=NGRAM_SIZE)
+    
+    class Meta:
+        unique_together=[('gram', 'lexem')]
+    
+    def __str__(self):
+        return self.gram
+
+
 models.CharField.register_lookup(Lower)
 
 class Token(str):
-    pass
+    prefix=" "
+    sticky=False
 
 class IndexEntry(models.Model):
     length=models.PositiveIntegerField(editable=False)
+    digest=models.CharField(max_length=32, editable=False, default='')
     occurrences=OccurrencesField(query_name="occurrence")
     
     object_field="object"
+    modified_field=None
+    storage="occurrences"
+    rank_by="proximity"
+    deferred=False
+    streaming=False
+    shards=None
     objects=IndexEntryManager()
 
     search_template=None
@@ -53,72 +91,239 @@ class IndexEntry(models.Model):
         
     
     def save(self, force_insert=False, force_update=False, using=None, 
-        update_fields=None):
-        logger.info(f"Indexing {self}...")
-        self.length=len(self.tokens)
-        super().save(force_insert=force_insert, 
-                            force_update=force_update, 
-                            using=using, 
-                            update_fields=update_fields)
+        update_fields=None, reindex=True):
+        occurrences_changed=False
+        if reindex:
+            logger.info(f"Indexing {self}...")
+            digest, self.length = self.tokens_digest()
+            occurrences_changed=digest!=self.digest
+            self.digest=digest
+        created=self._state.adding
+        using=(using or self.shard_for(self.serializable_value(self.object_field)) 
+               or router.db_for_write(self.__class__, instance=self))
+        with transaction.atomic(using=using):
+            super().save(force_insert=force_insert, 
+                                force_update=force_update, 
+                                using=using, 
+                                update_fields=update_fields)
+            if occurrences_changed:
+                self.update_occurrences(created)
+            transaction.on_commit(lambda: invalidate_results(self.__class__), using=using)
+    
+    def update_occurrences(self, created=False):
+        self._meta.get_field('occurrences').update_occurrences(self, created)
+    
+    @classmethod
+    def update_index(cls, instance, **kwargs):
+        if cls.deferred:
+            cls.objects.enqueue([instance])
+        else:
+            cls.objects.refresh([instance])
+    
+    @classmethod
+    def delete_index(cls, instance, **kwargs):
+        cls.objects.db_manager(cls.shard_for(instance.pk)).filter(
+            **{cls.object_field:instance.pk}).delete()
+    
+    @classmethod
+    def shard_for(cls, pk):
+        if not cls.shards:
+            return None
+        return cls.shards[zlib.crc32(str(pk).encode())%len(cls.shards)]
     
     @cached_property
     def tokens(self):
         return list(self.prepare_text())
     
+    def iter_tokens(self):
+        return self.prepare_text() if self.streaming else iter(self.tokens)
+    
+    def tokens_digest(self):
+        digest=hashlib.blake2b(digest_size=16)
+        length=0
+        for token in self.iter_tokens():
+            digest.update(f"{getattr(token, 'prefix', ' ')}\0{token}\0".encode())
+            length+=1
+        return digest.hexdigest(), length
+    
     def prepare_text(self):
+        if self.streaming:
+            return self.tokenize_chunks(self.text_chunks())
         return self.tokenize(self.rendered_text)
     
+    def text_chunks(self):
+        # The template is rendered node by node, e.g. a field per chunk, without keeping the whole text.
+        template=get_template(self.search_template)
+        context={self.object_field:getattr(self, self.object_field)}
+        nodelist=getattr(getattr(template, 'template', None), 'nodelist', None)
+        if nodelist is None:
+            yield template.render(context)
+            return
+        template=template.template
+        context=make_context(context, autoescape=template.engine.autoescape)
+        with context.render_context.push_state(template), context.bind_template(template):
+            for node in nodelist:
+                yield node.render_annotated(context)
+    
     token_pattern = re.compile(r'[^\s"]+')
     quote = '"'
     
     @classmethod
     def tokenize(cls, text):
-        i=0
+        for token in cls.scan_tokens(text):
+            if token == text and not token.sticky and len(token) >= MIN_SUBSTR_LEN:
+                token.lookup = "contains"
+            yield token
+    
+    @classmethod
+    def tokenize_chunks(cls, chunks):
+        if hasattr(chunks, 'read'):
+            chunks=iter(partial(chunks.read, STREAM_CHUNK_SIZE), '')
+        buffer=""
         sticky=False
-        while True:
-            res=cls.token_pattern.search(text, i)
-            if not res:
+        for chunk in chunks:
+            buffer=buffer+chunk if buffer else chunk
+            end, sticky = yield from cls.scan_tokens(buffer, sticky, more=True)
+            buffer=buffer[end:]
+        yield from cls.scan_tokens(buffer, sticky)
+    
+    @classmethod
+    def scan_tokens(cls, text, sticky=False, more=False):
+        quote=cls.quote
+        end=0
+        for match in cls.token_pattern.finditer(text):
+            if more and match.end()==len(text):
                 break
+            token = Token(match.group())
+            prefix=text[end:match.start()]
+            if prefix!=" ":
+                # Whitespace other than a single space is either two spaces in a row or not printable.
+                if "  " in prefix or not prefix.isprintable():
+                    prefix=WHITESPACE.sub(" ", prefix)
+                token.prefix=prefix
             
-            token = Token(res.group(0))
-            token.prefix=re.sub(r"\s+"," ",text[i:res.start()])
-            if cls.quote:
-                quotes=token.prefix.count(cls.quote)
-                if sticky and quotes>0:
+            toggle=False
+            if quote and quote in prefix:
+                quotes=prefix.count(quote)
+                if sticky:
                     sticky = False
                     quotes-=1
-                
-                token.sticky=sticky
-                if quotes%2>0:
-                    sticky=not sticky
-            i=res.end()
-            if not sticky and token == text and len(token) >= MIN_SUBSTR_LEN:
-                token.lookup = "contains"
+                toggle=quotes%2>0
+            if sticky:
+                token.sticky=True
+            if toggle:
+                sticky=not sticky
+            end=match.end()
             yield token
+        return end, sticky
     
     @classmethod
-    def parse_query(cls, query):
+    def parse_query(cls, query, using=None):
         lookup = 'surface'
-        if query.islower():
+        case_insensitive=query.islower()
+        if case_insensitive:
             lookup +="__lower"
         tokens=list(cls.tokenize(query))
+        lexicon=get_lexicon(using)
+        max_ids=connections[using or router.db_for_read(Lexem)].features.max_query_params
         
         query=[]
         for token in tokens:
             token.lookup = lookup + "__" + getattr(token,"lookup", "exact")
-            lqs = Lexem.objects.filter(**{token.lookup: token})
-            if token.lookup.endswith("__contains"):
-                lqs=lqs.order_by(Length("surface"))[:20000]
+            lookups=[(token.lookup, token)]
+            if token.lookup.endswith("__contains"):
+                lqs = Lexem.objects.containing(token.lookup, token)
+                if case_insensitive:
+                    lookups.append(("normalized__exact", normalize(token)))
+                    lqs = Lexem.objects.filter(models.Q(normalized=normalize(token))|models.Q(pk__in=lqs))
+            elif case_insensitive:
+                token.lookup = "normalized__exact"
+                lookups=[(token.lookup, normalize(token))]
+                lqs = Lexem.objects.filter(normalized=normalize(token))
+            else:
+                lqs = Lexem.objects.filter(**{token.lookup: token})
+            ids=lexicon.resolve(lookups) if lexicon else None
+            if ids is not None and (max_ids is None or len(ids)<=max_ids):
+                lqs = Lexem.objects.filter(pk__in=ids)
             condition=models.Q(lexem__in=lqs)
             condition.token = token
+            condition.lexems = lqs
             query.append(condition)
         return query
         
-    @property
+    @cached_property
     def excerpt(self):
+        windows=self.excerpt_windows()
+        if not windows:
+            return ""
+        words=self.fetch_words({self.pk:windows}, self._state.db)
+        return self.build_excerpt(words[self.pk], self.matches)
+    
+    @classmethod
+    def prefetch_excerpts(cls, entries):
+        for batch in batches(entries, EXCERPT_BATCH_SIZE):
+            windows={entry.pk:entry.excerpt_windows() for entry in batch}
+            words=cls.fetch_words({pk:ranges for pk, ranges in windows.items() if ranges},
+                                  batch[0]._state.db)
+            cls.render_excerpts(batch, windows, words)
+    
+    @classmethod
+    def render_excerpts(cls, entries, windows, words):
+        for entry in entries:
+            entry.excerpt=entry.build_excerpt(words[entry.pk], entry.matches) if windows[entry.pk] else ""
+    
+    async def aexcerpt(self):
+        if 'excerpt' not in self.__dict__:
+            await self.aprefetch_excerpts([self])
+        return self.excerpt
+    
+    @classmethod
+    async def aprefetch_excerpts(cls, entries):
+        for batch in batches(entries, EXCERPT_BATCH_SIZE):
+            windows={entry.pk:entry.excerpt_windows() for entry in batch}
+            words=await cls.afetch_words({pk:ranges for pk, ranges in windows.items() if ranges},
+                                         batch[0]._state.db)
+            # highlight() and to_html() may be overridden with synchronous code.
+            await sync_to_async(cls.render_excerpts)(batch, windows, words)
+    
+    @classmethod
+    def fetch_words(cls, windows, using=None):
+        if cls.storage=="postings":
+            from .postings import document_words
+            return document_words(cls, windows, using)
+        
+        entry_field=cls._meta.get_field('occurrences').m2m_field_name()
+        words=defaultdict(list)
+        for word in cls.window_words(windows, using):
+            words[getattr(word, f"{entry_field}_id")].append(word)
+        return words
+    
+    @classmethod
+    async def afetch_words(cls, windows, using=None):
+        if cls.storage=="postings":
+            from .postings import document_words
+            return await sync_to_async(document_words)(cls, windows, using)
+        
+        entry_field=cls._meta.get_field('occurrences').m2m_field_name()
+        words=defaultdict(list)
+        async for word in cls.window_words(windows, using):
+            words[getattr(word, f"{entry_field}_id")].append(word)
+        return words
+    
+    @classmethod
+    def window_words(cls, windows, using=None):
+        entry_field=cls._meta.get_field('occurrences').m2m_field_name()
+        conditions=[models.Q(**{entry_field:pk}, position__gt=start, position__lt=end)
+                    for pk, ranges in windows.items() for start, end in ranges]
+        words=cls.occurrences.db_manager(using)
+        if not conditions:
+            return words.none()
+        return words.filter(models.Q(*conditions, _connector=models.Q.OR)).select_related('lexem')
+    
+    def excerpt_windows(self):
         matches=getattr(self, 'matches', None)
         if not matches:
-            return ""
+            return []
         
         best_matches={matches[0].lexem_id:(matches[0], 0xFFFF)}
         last_match=matches[0]
@@ -138,18 +343,15 @@ class IndexEntry(models.Model):
             
         additional_context=(MAX_EXCERPT_FRAGMENTS-len(best_matches))*EXCERPT_ADDITONAL_CONTEXT_FACTOR
         
-        words=self.occurrences.filter(models.Q(*[
-            models.Q(position__gt=match.position+EXCERPT_FRAGMENT_START_OFFSET-additional_context,
-                     position__lt=match.position+EXCERPT_FRAGMENT_END_OFFSET+additional_context)
-            for match in best_matches], _connector=models.Q.OR))
-        
-        return self.build_excerpt(words, matches)
+        return [(match.position+EXCERPT_FRAGMENT_START_OFFSET-additional_context,
+                 match.position+EXCERPT_FRAGMENT_END_OFFSET+additional_context)
+                for match in best_matches]
     
     def build_excerpt(self, words, matches):
         highlight={m.position:m for m in matches}
         excerpt=""
         pos=-1
-        for word in words.select_related('lexem'):
+        for word in words:
             if word.position>pos+1:
                 excerpt+="..."
             if pos>0:
@@ -170,8 +372,9 @@ class IndexEntry(models.Model):
         if word.token.lookup.endswith("contains"):
             flags = re.IGNORECASE if "__lower__" in word.token.lookup else 0
             pattern = re.compile("(.*?)(("+re.escape(word.token)+")|$)", flags)
-            return "".join([self.to_html(part[0]) + self.to_html(part[1], True) 
-                            for part in pattern.findall(word.lexem.surface)])
+            parts = pattern.findall(word.lexem.surface)
+            if any(part[1] for part in parts):
+                return "".join([self.to_html(part[0]) + self.to_html(part[1], True) for part in parts])
         return self.to_html(word.lexem.surface, True)
 
     def to_html(self, surface, highlight=False):
@@ -189,13 +392,41 @@ class IndexEntry(models.Model):
         
     @cached_property
     def indexed_text(self):
-        return "".join([o.prefix+o.lexem.surface for o in self.occurrences.select_related('lexem')])
+        if self.storage=="postings":
+            from .postings import document_words
+            words=document_words(self.__class__, {self.pk:None}, self._state.db)[self.pk]
+        else:
+            words=self.occurrences.select_related('lexem')
+        return "".join([o.prefix+o.lexem.surface for o in words])
         
     @classmethod
     def get_index_queryset(cls):
         return cls.objects.target_model._meta.default_manager.all()
     
 
+def index_entry_deleting(sender, instance, using, **kwargs):
+    field=sender._meta.get_field('occurrences')
+    if sender.storage!="postings" and field.model is sender:
+        from .statistics import update_statistics
+        lexems=Counter(instance.occurrences.using(using).values_list('lexem', flat=True))
+        update_statistics(sender, lexems, {}, using)
+
+
+def index_entry_deleted(sender, instance, using, **kwargs):
+    if sender.storage=="postings":
+        from .postings import delete_postings
+        delete_postings(sender, instance.pk, using)
+    transaction.on_commit(lambda: invalidate_results(sender), using=using)
+
+
+def connect_index_entry_signals(sender, **kwargs):
+    if issubclass(sender, IndexEntry) and not sender._meta.abstract:
+        pre_delete.connect(index_entry_deleting, sender=sender)
+        post_delete.connect(index_entry_deleted, sender=sender)
+
+class_prepared.connect(connect_index_entry_signals)
+
+
 class Index(ContentType):
     objects = IndexManager()
     class Meta:
@@ -207,3 +438,105 @@ class Index(ContentType):
     
     def entries(self):
         return self.model_class().objects.all().count()
+
+
+def get_index(model, using=None):
+    return ContentType.objects.db_manager(using).get_for_model(
+        model._meta.get_field('occurrences').model)
+
+
+class RebuildCheckpoint(models.Model):
+    index=models.ForeignKey(Index, on_delete=models.CASCADE, related_name='checkpoints')
+    after=models.CharField(max_length=255, null=True)
+    last=models.CharField(max_length=255)
+    count=models.PositiveIntegerField()
+    created=models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.index}: {self.after or ''}..{self.last}"
+
+
+class SearchLog(models.Model):
+    index=models.ForeignKey(Index, on_delete=models.CASCADE, related_name='searches')
+    query=models.CharField(max_length=255)
+    duration=models.FloatField(db_index=True)
+    queries=models.PositiveIntegerField()
+    results=models.PositiveIntegerField(null=True)
+    phases=models.JSONField(default=dict)
+    tokens=models.JSONField(default=list)
+    explain=models.TextField(blank=True)
+    created=models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return f"{self.query} ({self.duration*1000:.0f} ms)"
+
+
+def log_slow_search(sender, profile, **kwargs):
+    if profile.duration<SLOW_SEARCH_THRESHOLD:
+        return
+    SearchLog.objects.create(index=get_index(sender), query=profile.query[:255], 
+                             duration=profile.duration, queries=profile.query_count,
+                             results=profile.count, tokens=profile.tokens, explain=profile.explain or "",
+                             phases={phase:{'seconds':seconds, 'queries':profile.queries.get(phase, 0)} 
+                                     for phase, seconds in profile.phases.items()})
+
+if SLOW_SEARCH_THRESHOLD is not None:
+    search_profiled.connect(log_slow_search)
+
+
+class IndexRequest(models.Model):
+    index=models.ForeignKey(Index, on_delete=models.CASCADE, related_name='requests')
+    object_id=models.CharField(max_length=255)
+    requested=models.DateTimeField(db_index=True)
+    updated=models.DateTimeField()
+    
+    objects=IndexRequestManager()
+    
+    class Meta:
+        unique_together=[('index', 'object_id')]
+    
+    def __str__(self):
+        return f"{self.index}: {self.object_id}"
+
+
+class PostingList(models.Model):
+    index=models.ForeignKey(Index, on_delete=models.CASCADE, related_name='+')
+    lexem=models.ForeignKey(Lexem, on_delete=models.CASCADE, related_name='+')
+    block=models.PositiveIntegerField()
+    data=models.BinaryField()
+    
+    class Meta:
+        unique_together=[('index', 'lexem', 'block')]
+
+
+class PostingDocument(models.Model):
+    index=models.ForeignKey(Index, on_delete=models.CASCADE, related_name='+')
+    entry=models.PositiveIntegerField()
+    data=models.BinaryField()
+    
+    class Meta:
+        unique_together=[('index', 'entry')]
+
+
+class IndexStatistics(models.Model):
+    index=models.OneToOneField(Index, on_delete=models.CASCADE, primary_key=True, 
+                               related_name='statistics')
+    documents=models.IntegerField(default=0)
+    length=models.BigIntegerField(default=0)
+    
+    class Meta:
+        verbose_name_plural="index statistics"
+    
+    @property
+    def average_length(self):
+        return self.length/self.documents if self.documents else 0.0
+
+
+class LexemStatistics(models.Model):
+    index=models.ForeignKey(Index, on_delete=models.CASCADE, related_name='+')
+    lexem=models.ForeignKey(Lexem, on_delete=models.CASCADE, related_name='+')
+    documents=models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together=[('index', 'lexem')]
+        verbose_name_plural="lexem statistics"
@@ -0,0 +1,46 @@
+import unicodedata
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+STEMMER_LANGUAGE = getattr(settings, "SEARCH_STEMMER_LANGUAGE", "english")
+
+
+def casefold(text):
+    return text.casefold()
+
+
+def nfkc(text):
+    return unicodedata.normalize("NFKC", text)
+
+
+def fold_accents(text):
+    if text.isascii():
+        return text
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+@lru_cache(maxsize=None)
+def get_stemmer(language):
+    try:
+        import snowballstemmer
+    except ImportError:
+        raise ImproperlyConfigured("Stemming requires snowballstemmer package to be installed.")
+    return snowballstemmer.stemmer(language)
+
+
+def stem(text):
+    return get_stemmer(STEMMER_LANGUAGE).stemWord(text)
+
+
+NORMALIZERS = [import_string(path) if isinstance(path, str) else path
+               for path in getattr(settings, "SEARCH_NORMALIZERS", [
+                   "django_native_search.normalizers.casefold"])]
+
+
+def normalize(surface, max_length=255):
+    for normalizer in NORMALIZERS:
+        surface=normalizer(surface)
+    return surface[:max_length]
@@ -0,0 +1,298 @@
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import chain
+
+from .manager import batches, ranked_keywords
+from .models import Lexem, PostingList, PostingDocument, get_index
+from .statistics import update_statistics, bm25_weights, bm25_score
+
+POSTINGS_BLOCK_SIZE = 1024
+
+
+def encode_varints(values, out):
+    for value in values:
+        while value>0x7F:
+            out.append(value&0x7F|0x80)
+            value>>=7
+        out.append(value)
+    return out
+
+
+def decode_varints(data):
+    value=shift=0
+    for byte in data:
+        value|=(byte&0x7F)<<shift
+        if byte&0x80:
+            shift+=7
+            continue
+        yield value
+        value=shift=0
+
+
+def encode_postings(postings):
+    out=bytearray()
+    last_entry=0
+    for entry in sorted(postings):
+        positions=postings[entry]
+        encode_varints((entry-last_entry, len(positions)), out)
+        last=0
+        for position in positions:
+            encode_varints((position-last,), out)
+            last=position
+        last_entry=entry
+    return bytes(out)
+
+
+def decode_postings(data):
+    postings={}
+    values=decode_varints(bytes(data))
+    entry=0
+    for delta in values:
+        entry+=delta
+        position=0
+        positions=[]
+        for _ in range(next(values)):
+            position+=next(values)
+            positions.append(position)
+        postings[entry]=positions
+    return postings
+
+
+def read_varint(data, i):
+    value=shift=0
+    while True:
+        byte=data[i]
+        i+=1
+        value|=(byte&0x7F)<<shift
+        if not byte&0x80:
+            return value, i
+        shift+=7
+
+
+def encode_document(rows):
+    out=bytearray()
+    last=-1
+    for position in sorted(rows):
+        lexem, prefix = rows[position]
+        prefix=None if prefix==' ' else prefix.encode()
+        encode_varints((position-last, lexem, 0 if prefix is None else len(prefix)+1), out)
+        out.extend(prefix or b'')
+        last=position
+    return bytes(out)
+
+
+def decode_document(data):
+    data=bytes(data)
+    rows={}
+    position=-1
+    i=0
+    while i<len(data):
+        delta, i = read_varint(data, i)
+        lexem, i = read_varint(data, i)
+        prefix_length, i = read_varint(data, i)
+        position+=delta
+        if prefix_length:
+            prefix=data[i:i+prefix_length-1].decode()
+            i+=prefix_length-1
+        else:
+            prefix=' '
+        rows[position]=(lexem, prefix)
+    return rows
+
+
+def positions_by_lexem(rows):
+    positions=defaultdict(list)
+    for position in sorted(rows):
+        positions[rows[position][0]].append(position)
+    return positions
+
+
+class Word:
+    __slots__=('position', 'lexem_id', 'prefix', 'lexem', 'token')
+
+    def __init__(self, position, lexem_id, prefix=' ', token=None):
+        self.position=position
+        self.lexem_id=lexem_id
+        self.prefix=prefix
+        self.lexem=None
+        self.token=token
+
+
+def update_postings(model, entry, rows, using):
+    index=get_index(model, using)
+    documents=PostingDocument.objects.using(using).filter(index=index, entry=entry)
+    document=documents.first()
+    old=positions_by_lexem(decode_document(document.data)) if document else {}
+    new=positions_by_lexem(rows)
+    changed=sorted(lexem for lexem in set(old)|set(new) if old.get(lexem)!=new.get(lexem))
+    update_statistics(model, {lexem:len(positions) for lexem, positions in old.items()},
+                      {lexem:len(positions) for lexem, positions in new.items()}, using)
+
+    block=entry//POSTINGS_BLOCK_SIZE
+    lists=PostingList.objects.using(using)
+    for batch in batches(changed):
+        lists.bulk_create([PostingList(index=index, lexem_id=lexem, block=block, data=b'')
+                           for lexem in batch], ignore_conflicts=True)
+        updated=[]
+        empty=[]
+        # Rows are locked in lexem order, in any other order concurrent updates could deadlock.
+        for posting_list in lists.select_for_update().filter(index=index, block=block, lexem__in=batch
+                                                             ).order_by('lexem'):
+            postings=decode_postings(posting_list.data)
+            positions=new.get(posting_list.lexem_id)
+            if positions:
+                postings[entry]=positions
+            else:
+                postings.pop(entry, None)
+            if postings:
+                posting_list.data=encode_postings(postings)
+                updated.append(posting_list)
+            else:
+                empty.append(posting_list.pk)
+        lists.bulk_update(updated, ['data'])
+        lists.filter(pk__in=empty).delete()
+
+    if not rows:
+        documents.delete()
+    elif document:
+        documents.update(data=encode_document(rows))
+    else:
+        documents.create(index=index, entry=entry, data=encode_document(rows))
+
+
+def delete_postings(model, entry, using):
+    update_postings(model, entry, {}, using)
+
+
+def load_postings(model, lexems, using, blocks=None):
+    postings=defaultdict(list)
+    lists=PostingList.objects.using(using).filter(index=get_index(model, using))
+    if blocks is not None:
+        lists=lists.filter(block__in=blocks)
+    for batch in batches(lexems):
+        for posting_list in lists.filter(lexem__in=batch):
+            for entry, positions in decode_postings(posting_list.data).items():
+                postings[entry].extend((position, posting_list.lexem_id) for position in positions)
+    return postings
+
+
+def proximity(keywords):
+    best={position:(1.0, 1) for position in keywords[0][0]}
+    for positions, sticky in keywords[1:]:
+        previous=sorted(best)
+        if sticky:
+            best={q:best[q-1] for q in positions if q-1 in best}
+            if not best:
+                return None
+            continue
+        total=sum(count for _, count in best.values())
+        left=[]
+        minimum=None
+        for p in previous:
+            value=best[p][0]-p
+            minimum=value if minimum is None or value<minimum else minimum
+            left.append(minimum)
+        right=[0.0]*len(previous)
+        minimum=None
+        for i in range(len(previous)-1, -1, -1):
+            value=best[previous[i]][0]+previous[i]
+            minimum=value if minimum is None or value<minimum else minimum
+            right[i]=minimum
+        best={}
+        for q in positions:
+            i=bisect_left(previous, q)
+            candidates=[]
+            if i>0:
+                candidates.append(left[i-1]+q-1)
+            if i<len(previous):
+                candidates.append(right[i]-q+1)
+            best[q]=(min(candidates), total)
+    distance=min(distance for distance, _ in best.values())
+    return distance/sum(count for _, count in best.values())
+
+
+def is_phrase_matched(groups, phrases, entry):
+    for phrase in phrases:
+        ends=set(groups[phrase[0]][entry])
+        for i in phrase[1:]:
+            ends=set(p+1 for p in ends)&set(groups[i][entry])
+            if not ends:
+                return False
+    return True
+
+
+def search_postings(queryset, conditions, rank_by="proximity"):
+    model=queryset.model
+    using=queryset.db
+    groups=[]
+    phrases=[]
+    sticky=set()
+    for i, condition in enumerate(conditions):
+        postings=load_postings(model, condition.lexems.using(using).values_list('pk', flat=True), using)
+        groups.append({entry:[position for position, _ in positions]
+                       for entry, positions in postings.items()})
+        if i>0 and getattr(condition.token, 'sticky', False):
+            sticky.add(i)
+            if phrases and phrases[-1][-1]==i-1:
+                phrases[-1].append(i)
+            else:
+                phrases.append([i-1, i])
+
+    candidates=set(min(groups, key=len)) if groups else set()
+    for group in groups:
+        candidates.intersection_update(group)
+    candidates=[entry for entry in candidates if is_phrase_matched(groups, phrases, entry)]
+
+    if rank_by=="bm25":
+        average_length, weights = bm25_weights(model, conditions, using)
+    units=[]
+    for i in range(len(conditions)):
+        if i in sticky:
+            units[-1].append(i)
+        else:
+            units.append([i])
+    units.sort(key=lambda unit: min(len(groups[i]) for i in unit))
+    ranked=sorted(ranked_keywords(conditions, [conditions[i] for unit in units for i in unit]))
+    ranking=[]
+    for batch in batches(candidates):
+        for pk, length in queryset.filter(pk__in=batch).values_list('pk', 'length'):
+            if rank_by=="bm25":
+                ranking.append((pk, -bm25_score([len(group[pk]) for group in groups], 
+                                                weights, length, average_length)))
+                continue
+            rank=proximity([(sorted(groups[i][pk]), i in sticky) for i in ranked])
+            if rank is not None:
+                ranking.append((pk, rank*length))
+    ranking.sort(key=lambda item: (item[1], item[0]))
+    return queryset.ranked(ranking, conditions)
+
+
+def attach_matches(entries, conditions, using):
+    if not entries:
+        return
+    model=type(entries[0])
+    tokens={}
+    for condition in conditions:
+        for lexem in condition.lexems.using(using).values_list('pk', flat=True):
+            tokens.setdefault(lexem, condition.token)
+    postings=load_postings(model, list(tokens), using,
+                           set(entry.pk//POSTINGS_BLOCK_SIZE for entry in entries))
+    for entry in entries:
+        entry.matches=[Word(position, lexem, token=tokens[lexem])
+                       for position, lexem in sorted(postings.get(entry.pk, []))]
+
+
+def document_words(model, windows, using):
+    documents=PostingDocument.objects.using(using).filter(index=get_index(model, using), 
+                                                          entry__in=list(windows))
+    words=defaultdict(list)
+    for entry, data in documents.values_list('entry', 'data'):
+        ranges=windows[entry]
+        for position, (lexem, prefix) in sorted(decode_document(data).items()):
+            if ranges is None or any(start<position<end for start, end in ranges):
+                words[entry].append(Word(position, lexem, prefix))
+
+    lexems=Lexem.objects.using(using).in_bulk(set(word.lexem_id for word in chain(*words.values())))
+    for word in chain(*words.values()):
+        word.lexem=lexems[word.lexem_id]
+    return words
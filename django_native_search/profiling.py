@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .signals import search_profiled
+
+PROFILING = getattr(settings, "SEARCH_PROFILING", False)
+PROFILE_EXPLAIN = getattr(settings, "SEARCH_PROFILE_EXPLAIN", False)
+SLOW_SEARCH_THRESHOLD = getattr(settings, "SEARCH_SLOW_SEARCH_THRESHOLD", None)
+
+
+class SearchProfile:
+    def __init__(self, model, query):
+        self.model=model
+        self.query=query
+        self.tokens=[]
+        self.phases={}
+        self.queries={}
+        self.count=None
+        self.results=None
+        self.explain=None
+        self.created=timezone.now()
+        self.emitted=False
+        self.stack=[]
+    
+    @property
+    def duration(self):
+        return sum(self.phases.values())
+    
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+    
+    @contextmanager
+    def phase(self, name, using):
+        self.stack.append([name, 0.0])
+        self.queries.setdefault(name, 0)
+        started=time.perf_counter()
+        try:
+            if len(self.stack)>1:
+                yield
+            else:
+                with connections[using].execute_wrapper(self.count_query):
+                    yield
+        finally:
+            elapsed=time.perf_counter()-started
+            _, children = self.stack.pop()
+            self.phases[name]=self.phases.get(name, 0.0)+elapsed-children
+            if self.stack:
+                self.stack[-1][1]+=elapsed
+    
+    def count_query(self, execute, sql, params, many, context):
+        self.queries[self.stack[-1][0]]+=1
+        return execute(sql, params, many, context)
+    
+    def emit(self):
+        if self.emitted:
+            return
+        self.emitted=True
+        search_profiled.send(sender=self.model, profile=self)
+    
+    def __repr__(self):
+        return (f"<SearchProfile {self.query!r}: {self.duration*1000:.1f} ms, "
+                f"{self.query_count} queries>")
@@ -0,0 +1,30 @@
+from django.db import router
+
+
+def is_sharded(instance):
+    return bool(getattr(instance, 'shards', None))
+
+
+class ShardRouter:
+    """
+    Reads and writes the objects related to sharded index entries in their own databases,
+    instead of the shard the entry was loaded from.
+    """
+    def db_for_read(self, model, **hints):
+        return self.db_for_related(model, hints, router.db_for_read)
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_related(model, hints, router.db_for_write)
+
+    def db_for_related(self, model, hints, route):
+        instance=hints.get('instance')
+        if not is_sharded(instance) or isinstance(instance, model) or model._meta.auto_created:
+            return None
+        if model._meta.app_label=="django_native_search":
+            return None
+        return route(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(obj1) or is_sharded(obj2):
+            return True
+        return None
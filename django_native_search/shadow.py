@@ -0,0 +1,178 @@
+import copy
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.db import NotSupportedError, connections, router
+from django.db.backends.utils import truncate_name
+from django.db.migrations.state import ProjectState
+from django.utils import timezone
+
+from .cache import invalidate_results
+
+logger = logging.getLogger(__name__)
+
+VENDORS = ("sqlite", "postgresql")
+
+local = threading.local()
+
+
+def shadowing(model):
+    return model in getattr(local, 'models', ())
+
+
+def shadow_occurrences(model, using):
+    """
+    Occurrence models of the shadow tables of a running online rebuild of the index, and of the old 
+    tables still being dropped.
+    """
+    live=model._meta.get_field('occurrences').remote_field.through._meta.db_table
+    for table in connections[using].introspection.table_names():
+        if table.startswith(f"{live}__s") or table.startswith(f"{live}__o"):
+            copy=ProjectState.from_apps(apps).apps.get_model(model._meta.label)
+            through=copy._meta.get_field('occurrences').remote_field.through
+            through._meta.db_table=table
+            yield through
+
+
+class ShadowTables:
+    """
+    Copy of the entry and occurrence tables of an index, which is built aside of the live tables
+    and swapped in by renaming.
+    """
+    def __init__(self, model, suffix=None):
+        self.model=model
+        self.field=model._meta.get_field(model.object_field)
+        self.throughs=[field.remote_field.through for field in model._meta.local_many_to_many
+                       if field.remote_field.through._meta.auto_created]
+        self.using=router.db_for_write(model)
+        self.connection=connections[self.using]
+        self.suffix=suffix or format(time.time_ns(), 'x')
+        self.constrained=self.field.db_constraint
+        self.live={m:m._meta.db_table for m in (*self.throughs, model)}
+
+    def name(self, table, kind):
+        return truncate_name(f"{table}__{kind}{self.suffix}", self.connection.ops.max_name_length())
+
+    def tables(self, kind):
+        return [self.name(table, kind) for table in self.live.values()]
+
+    def check(self):
+        label=self.model._meta.label
+        if self.connection.vendor not in VENDORS:
+            raise NotSupportedError(f"Online rebuild is not supported on {self.connection.vendor}.")
+        if self.model.storage=="postings" or self.model._meta.parents or self.model.shards:
+            raise NotSupportedError(f"Online rebuild of {label} is not supported, only unsharded "
+                                    "occurrence tables without parent indexes can be swapped.")
+        related=[rel for rel in self.model._meta.related_objects
+                 if rel.related_model not in self.throughs]
+        if related:
+            raise NotSupportedError(f"Online rebuild of {label} is not supported, "
+                                    f"it is referenced by {related[0].related_model._meta.label}.")
+
+    @contextmanager
+    def activate(self):
+        """
+        Rewrites the queries of the current thread to the shadow tables. The models are left
+        untouched, so other threads keep using the live tables.
+        """
+        quote=self.connection.ops.quote_name
+        tables={quote(table):quote(self.name(table, "s")) for table in self.live.values()}
+        pattern=re.compile("|".join(map(re.escape, tables)))
+
+        def execute(execute, sql, params, many, context):
+            return execute(pattern.sub(lambda match: tables[match.group()], sql), params, many, context)
+
+        models=getattr(local, 'models', set())
+        local.models=models|{self.model}
+        try:
+            with self.connection.execute_wrapper(execute):
+                yield self
+        finally:
+            local.models=models
+
+    def create(self):
+        self.drop(self.stale_tables())
+        model=ProjectState.from_apps(apps).apps.get_model(self.model._meta.label)
+        for m in (model, *(field.remote_field.through for field in model._meta.local_many_to_many
+                           if field.remote_field.through._meta.auto_created)):
+            m._meta.db_table=self.name(m._meta.db_table, "s")
+        # Objects deleted while building must not be held by the shadow copy.
+        model._meta.get_field(self.field.name).db_constraint=False
+        with self.connection.schema_editor() as editor:
+            editor.create_model(model)
+
+    def swap(self, since=None):
+        model=self.model
+        manager=model._base_manager.db_manager(self.using)
+        catch_up=since is not None and model.modified_field
+        if since is not None and not model.modified_field:
+            logger.warning(f"Modification field of {model._meta.label} is not configured, "
+                           "changes made during the online rebuild are not caught up.")
+        checkpoint=timezone.now()
+        if catch_up:
+            with self.activate():
+                model._meta.default_manager.refresh(since=since)
+
+        with self.connection.schema_editor() as editor:
+            for m, table in self.live.items():
+                editor.alter_db_table(m, table, self.name(table, "o"))
+                editor.alter_db_table(m, self.name(table, "s"), table)
+            if self.constrained:
+                self.restore_constraint(editor)
+            if catch_up:
+                model._meta.default_manager.refresh(since=checkpoint)
+            target=self.field.remote_field.model
+            manager.exclude(**{f"{self.field.name}__in":target._base_manager.all()}).delete()
+
+        model._meta.default_manager.db_manager(self.using).rebuild_statistics()
+        invalidate_results(model)
+        logger.info(f"Swapped rebuilt tables of {model._meta.label}.")
+
+    def restore_constraint(self, editor):
+        if self.connection.vendor=="sqlite":
+            # Remaking the table recreates its indexes under their original names,
+            # which are still held by the old copy.
+            table=self.name(self.model._meta.db_table, "o")
+            with self.connection.cursor() as cursor:
+                constraints=self.connection.introspection.get_constraints(cursor, table)
+            for name, constraint in constraints.items():
+                if constraint['index'] and not constraint['primary_key'] and not name.startswith("sqlite_"):
+                    editor.execute(f"DROP INDEX {editor.quote_name(name)}")
+        # Tables are remade from the flattened model state, like in migrations.
+        model=ProjectState.from_apps(apps).apps.get_model(self.model._meta.label)
+        field=model._meta.get_field(self.field.name)
+        loose=copy.copy(field)
+        loose.db_constraint=False
+        editor.alter_field(model, loose, field)
+
+    def stale_tables(self):
+        tables=self.connection.introspection.table_names()
+        return [table for live in self.live.values() for table in tables
+                if table.startswith(f"{live}__s") or table.startswith(f"{live}__o")]
+
+    def drop(self, tables):
+        if not tables:
+            return
+        connection=connections[self.using]
+        with connection.schema_editor() as editor:
+            for table in tables:
+                editor.execute(editor.sql_delete_table % {"table":editor.quote_name(table)})
+        logger.info(f"Dropped tables {', '.join(tables)}.")
+
+    def drop_old(self):
+        thread=threading.Thread(target=self.drop_in_background, args=(self.tables("o"),),
+                                name=f"drop-{self.model._meta.label_lower}")
+        thread.start()
+        return thread
+
+    def drop_in_background(self, tables):
+        try:
+            self.drop(tables)
+        except Exception:
+            logger.exception(f"Exception raised when dropping tables {', '.join(tables)}")
+        finally:
+            connections[self.using].close()
@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import math
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .manager import HitCount, ResultsPage, decode_cursor, encode_cursor
+
+SHARD_THREADS = getattr(settings, "SEARCH_SHARD_THREADS", None)
+
+
+@lru_cache(maxsize=None)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=SHARD_THREADS, thread_name_prefix="search-shard")
+
+
+def scatter(function, items):
+    def run(item):
+        try:
+            return function(item)
+        finally:
+            close_old_connections()
+    return list(get_executor().map(run, items))
+
+
+def merge_counts(counts):
+    total=sum(counts)
+    if any(getattr(count, 'estimated', False) for count in counts):
+        return HitCount(total, estimated=True)
+    if any(isinstance(count, HitCount) for count in counts):
+        return HitCount(total)
+    return total
+
+
+def merge_facets(fields, results):
+    counts={field:Counter() for field in fields}
+    for facets in results:
+        for field, values in facets.items():
+            counts[field].update(dict(values))
+    return {field:sorted(values.items(), key=lambda item: (-item[1], item[0] is not None, item[0]))
+            for field, values in counts.items()}
+
+
+class ShardedResults:
+    """
+    Search results of a sharded index, merged from the results of all shards
+    ordered by rank, shard and primary key.
+    """
+    def __init__(self, querysets):
+        self.querysets=querysets
+        self._result_cache=None
+        self._count=None
+
+    @classmethod
+    def search(cls, queryset, query, rank_by=None):
+        return cls(scatter(lambda qs: qs.search(query, rank_by),
+                           [queryset.using(alias) for alias in queryset.model.shards]))
+
+    def merge(self, results):
+        for shard, entries in enumerate(results):
+            for entry in entries:
+                entry.shard=shard
+        return heapq.merge(*results, key=lambda entry: (entry.rank, entry.shard, entry.pk))
+
+    def fetch(self, querysets, limit=None):
+        return self.merge(scatter(lambda qs: list(qs if limit is None else qs[:limit]), querysets))
+
+    async def afetch(self, querysets, limit=None):
+        async def fetch(qs):
+            return [entry async for entry in (qs if limit is None else qs[:limit])]
+        return self.merge(await asyncio.gather(*map(fetch, querysets)))
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            self._result_cache=list(self.fetch(self.querysets))
+
+    def __iter__(self):
+        self._fetch_all()
+        return iter(self._result_cache)
+
+    def __len__(self):
+        self._fetch_all()
+        return len(self._result_cache)
+
+    def __bool__(self):
+        self._fetch_all()
+        return bool(self._result_cache)
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+        if isinstance(k, int):
+            if k<0:
+                raise ValueError("Negative indexing is not supported.")
+            return self[k:k+1][0]
+        if k.stop is None:
+            return list(self)[k]
+        return list(islice(self.fetch(self.querysets, k.stop), k.start, k.stop, k.step))
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._count is None:
+            self._count=merge_counts(scatter(lambda qs: qs.count(), self.querysets))
+        return self._count
+
+    async def acount(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._count is None:
+            self._count=merge_counts(await asyncio.gather(*(qs.acount() for qs in self.querysets)))
+        return self._count
+
+    def after(self, cursor):
+        rank, pk, shard = decode_cursor(cursor) if isinstance(cursor, str) else cursor
+        querysets=[]
+        for i, qs in enumerate(self.querysets):
+            if i==shard:
+                querysets.append(qs.after((rank, pk)))
+            else:
+                # Other shards continue with the rank either included or excluded.
+                querysets.append(qs.after((rank if i>shard else math.nextafter(rank, math.inf), None)))
+        return ShardedResults(querysets)
+
+    def page(self, size, cursor=None):
+        results=self.after(cursor) if cursor else self
+        return self.make_page(list(islice(results.fetch(results.querysets, size+1), size+1)), size)
+
+    async def apage(self, size, cursor=None):
+        results=self.after(cursor) if cursor else self
+        return self.make_page(list(islice(await results.afetch(results.querysets, size+1), size+1)), size)
+
+    def make_page(self, entries, size):
+        return ResultsPage(entries[:size], encode_cursor(entries[size-1]) if len(entries)>size else None)
+
+    def facets(self, *fields):
+        return merge_facets(fields, scatter(lambda qs: qs.facets(*fields), self.querysets))
+
+    async def afacets(self, *fields):
+        return merge_facets(fields, await asyncio.gather(*(qs.afacets(*fields) for qs in self.querysets)))
+
+    def prefetch_matches(self):
+        return ShardedResults([qs.prefetch_matches() for qs in self.querysets])
+
+    def prefetch_excerpts(self):
+        return ShardedResults([qs.prefetch_excerpts() for qs in self.querysets])
+
+
+def rebuild_shards(model, chunk_size):
+    manager=model._meta.default_manager
+
+    def refresh(objects):
+        try:
+            manager.refresh(objects)
+        finally:
+            connections.close_all()
+
+    pending={}
+    with ThreadPoolExecutor(max_workers=len(model.shards), thread_name_prefix="rebuild-shard") as executor:
+        def submit(alias, objects):
+            if alias in pending:
+                pending.pop(alias).result()
+            pending[alias]=executor.submit(refresh, objects)
+
+        chunks={}
+        for obj in model.get_index_queryset().iterator(chunk_size=chunk_size):
+            alias=model.shard_for(obj.pk)
+            chunk=chunks.setdefault(alias, [])
+            chunk.append(obj)
+            if len(chunk)>=chunk_size:
+                submit(alias, chunks.pop(alias))
+        for alias, chunk in chunks.items():
+            submit(alias, chunk)
+        for future in pending.values():
+            future.result()
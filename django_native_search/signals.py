@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent with the index model as sender and the SearchProfile as profile argument
+# after the results of a profiled search are fetched.
+search_profiled = Signal()
@@ -0,0 +1,152 @@
+import math
+from collections import Counter
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Count, F, Max, Sum
+
+from .manager import batches
+from .models import IndexStatistics, LexemStatistics, PostingList, get_index
+from .shadow import shadowing
+
+BM25_K1 = getattr(settings, "SEARCH_BM25_K1", 1.2)
+BM25_B = getattr(settings, "SEARCH_BM25_B", 0.75)
+PLAN_COUNT_LIMIT = getattr(settings, "SEARCH_PLAN_COUNT_LIMIT", 1000)
+
+
+def update_statistics(model, old, new, using):
+    if shadowing(model):
+        return
+    added=[lexem for lexem in new if lexem not in old]
+    removed=[lexem for lexem in old if lexem not in new]
+    documents=bool(new)-bool(old)
+    length=sum(new.values())-sum(old.values())
+    if not (added or removed or length):
+        return
+
+    index=get_index(model, using)
+    stats=IndexStatistics.objects.using(using)
+    stats.get_or_create(index=index)
+    stats.filter(index=index).update(documents=F('documents')+documents, length=F('length')+length)
+
+    lexems=LexemStatistics.objects.using(using).filter(index=index)
+    for batch in batches(added):
+        lexems.bulk_create([LexemStatistics(index=index, lexem_id=lexem) for lexem in batch],
+                           ignore_conflicts=True)
+        lexems.filter(lexem__in=batch).update(documents=F('documents')+1)
+    for batch in batches(removed):
+        lexems.filter(lexem__in=batch).update(documents=F('documents')-1)
+    if removed:
+        lexems.filter(documents__lte=0).delete()
+
+
+def rebuild_statistics(model, using=None):
+    from .postings import decode_postings
+
+    model=model._meta.get_field('occurrences').model
+    using=using or router.db_for_write(IndexStatistics)
+    index=get_index(model, using)
+    documents=Counter()
+    with transaction.atomic(using=using):
+        if model.storage=="postings":
+            entries=set()
+            length=0
+            for lexem, data in PostingList.objects.using(using).filter(index=index).values_list(
+                    'lexem', 'data').iterator():
+                postings=decode_postings(data)
+                documents[lexem]+=len(postings)
+                length+=sum(len(positions) for positions in postings.values())
+                entries.update(postings)
+            entries=len(entries)
+        else:
+            field=model._meta.get_field('occurrences')
+            entry_field=field.m2m_field_name()
+            occurrences=model.occurrences.db_manager(using).all()
+            documents.update(dict(occurrences.values_list(field.m2m_reverse_field_name()).annotate(
+                Count(entry_field, distinct=True)).order_by()))
+            length=occurrences.count()
+            entries=occurrences.values(entry_field).distinct().count()
+
+        lexems=LexemStatistics.objects.using(using).filter(index=index)
+        lexems.delete()
+        for batch in batches(documents.items()):
+            lexems.bulk_create([LexemStatistics(index=index, lexem_id=lexem, documents=count)
+                                for lexem, count in batch])
+        IndexStatistics.objects.using(using).update_or_create(
+            index=index, defaults={'documents':entries, 'length':length})
+
+
+def estimate_matches(model, conditions, using):
+    index=get_index(model, using)
+    statistics=IndexStatistics.objects.using(using).filter(index=index).exists()
+    estimates=[]
+    for condition in conditions:
+        lexems=condition.lexems.using(using)
+        estimate=0
+        if statistics:
+            estimate=LexemStatistics.objects.using(using).filter(index=index, lexem__in=lexems
+                                                                 ).aggregate(s=Sum('documents'))['s']
+        # Without statistics the matches are counted, only up to a limit to keep planning cheap.
+        if not estimate and model.storage=="postings":
+            estimate=PostingList.objects.using(using).filter(index=index, lexem__in=lexems
+                                                             )[:PLAN_COUNT_LIMIT].count()
+        elif not estimate:
+            estimate=model.occurrences.db_manager(using).filter(lexem__in=lexems
+                                                                )[:PLAN_COUNT_LIMIT].count()
+        estimates.append(estimate)
+    return estimates
+
+
+async def aestimate_matches(model, conditions, using):
+    # The index is looked up by its content type in the queries, without fetching it.
+    opts=model._meta.get_field('occurrences').model._meta
+    index={'index__app_label':opts.app_label, 'index__model':opts.model_name}
+    statistics=await IndexStatistics.objects.using(using).filter(**index).aexists()
+    estimates=[]
+    for condition in conditions:
+        lexems=condition.lexems.using(using)
+        estimate=0
+        if statistics:
+            estimate=(await LexemStatistics.objects.using(using).filter(lexem__in=lexems, **index
+                                                                        ).aaggregate(s=Sum('documents')))['s']
+        if not estimate and model.storage=="postings":
+            estimate=await PostingList.objects.using(using).filter(lexem__in=lexems, **index
+                                                                   )[:PLAN_COUNT_LIMIT].acount()
+        elif not estimate:
+            estimate=await model.occurrences.db_manager(using).filter(lexem__in=lexems
+                                                                      )[:PLAN_COUNT_LIMIT].acount()
+        estimates.append(estimate)
+    return estimates
+
+
+def estimate_total(model, conditions, using):
+    index=get_index(model, using)
+    stats=IndexStatistics.objects.using(using).filter(index=index).first()
+    if not stats or not stats.documents:
+        return None
+    estimate=stats.documents
+    lexems=LexemStatistics.objects.using(using).filter(index=index)
+    for condition in conditions:
+        documents=lexems.filter(lexem__in=condition.lexems.using(using)).aggregate(
+            d=Sum('documents'))['d'] or 0
+        estimate*=min(documents, stats.documents)/stats.documents
+    return round(estimate)
+
+
+def bm25_weights(model, conditions, using):
+    index=get_index(model, using)
+    stats=IndexStatistics.objects.using(using).filter(index=index).first()
+    total=stats.documents if stats else 0
+    lexems=LexemStatistics.objects.using(using).filter(index=index)
+    weights=[]
+    for condition in conditions:
+        documents=lexems.filter(lexem__in=condition.lexems.using(using)).aggregate(
+            d=Max('documents'))['d'] or 0
+        weights.append(math.log((total-documents+0.5)/(documents+0.5)+1))
+    return (stats.average_length if stats else 0.0) or 1.0, weights
+
+
+def bm25_score(frequencies, weights, length, average_length):
+    norm=BM25_K1*(1-BM25_B+BM25_B*length/average_length)
+    return sum(weight*frequency*(BM25_K1+1)/(frequency+norm)
+               for frequency, weight in zip(frequencies, weights))
@@ -12,7 +12,7 @@ setuptools.setup(
     long_description_content_type='text/markdown',
     url='https://github.com/kmierzeje/django-native-search',
     packages=setuptools.find_packages(),
-    install_requires=['django>=3.2', 'django-expression-index>=0.1.0'],
+    install_requires=['django>=4.1', 'django-expression-index>=0.1.0'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
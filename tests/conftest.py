@@ -0,0 +1,18 @@
+import os
+
+import django
+import pytest
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+django.setup()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def django_test_environment():
+    from django.test.runner import DiscoverRunner
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    runner.setup_test_environment()
+    databases = runner.setup_databases()
+    yield
+    runner.teardown_databases(databases)
+    runner.teardown_test_environment()
@@ -0,0 +1,11 @@
+SECRET_KEY = "tests"
+INSTALLED_APPS = [
+    "django.contrib.contenttypes",
+    "django_native_search",
+    "tests.testapp",
+]
+DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}}
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+TEMPLATES = [{"BACKEND": "django.template.backends.django.DjangoTemplates", "APP_DIRS": True}]
+DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
+USE_TZ = True
@@ -0,0 +1,63 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_native_search.manager import SearchQuerySet, decode_cursor
+from tests.testapp.models import BookIndexEntry, PostingBookEntry
+from tests.utils import create_books
+
+
+class AsyncSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        books = create_books("apple pie", "red apple and green apple", "apple juice", "pear tart",
+                             index=BookIndexEntry)
+        PostingBookEntry.objects.refresh(books)
+
+    def position(self, page):
+        # Cursors are signed with a timestamp.
+        return page.next_cursor and decode_cursor(page.next_cursor)
+
+    def sync_results(self, index, query):
+        results = index.objects.search(query)
+        page = results.page(2)
+        return ([entry.pk for entry in page], self.position(page), results.count(), results.facets("length"),
+                [entry.excerpt for entry in results.prefetch_matches()])
+
+    async def async_results(self, index, query):
+        results = await index.objects.asearch(query)
+        page = await results.apage(2)
+        entries = [entry async for entry in results.prefetch_matches()]
+        await index.aprefetch_excerpts(entries[1:])
+        excerpts = [await entry.aexcerpt() for entry in entries[:1]] + [entry.excerpt for entry in entries[1:]]
+        return ([entry.pk for entry in page], self.position(page), await results.acount(),
+                await results.afacets("length"), excerpts)
+
+    async def test_same_as_sync(self):
+        for index in (BookIndexEntry, PostingBookEntry):
+            for query in ("apple", "apple pie", "cake"):
+                with self.subTest(index=index.__name__, query=query):
+                    self.assertEqual(await self.async_results(index, query),
+                                     await sync_to_async(self.sync_results)(index, query))
+
+    async def test_search_not_run_in_thread(self):
+        await sync_to_async(cache.clear)()
+        for cached in (None, "default", "default"):
+            for rank_by in ("proximity", "bm25"):
+                with self.subTest(cached=cached, rank_by=rank_by), \
+                        mock.patch("django_native_search.cache.RESULT_CACHE", cached):
+                    expected = await sync_to_async(lambda: [
+                        (entry.pk, entry.rank) for entry in BookIndexEntry.objects.search("apple pie", rank_by)])()
+                    with mock.patch.object(SearchQuerySet, "search", side_effect=AssertionError):
+                        results = await BookIndexEntry.objects.asearch("apple pie", rank_by)
+                    self.assertEqual([(entry.pk, entry.rank) async for entry in results], expected)
+
+    @mock.patch("django_native_search.cache.RESULT_CACHE", "default")
+    async def test_cached_facets(self):
+        await sync_to_async(cache.clear)()
+        results = await BookIndexEntry.objects.asearch("apple")
+        expected = await sync_to_async(results.facets)("length")
+        with mock.patch.object(SearchQuerySet, "facet_values", side_effect=AssertionError):
+            self.assertEqual(await results.afacets("length"), expected)
@@ -0,0 +1,109 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db.models import F
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from django_native_search.cache import generation_key
+from django_native_search.manager import SearchQuerySet
+from tests.testapp.models import Book, BookIndexEntry
+from tests.utils import create_books
+
+
+@mock.patch("django_native_search.cache.RESULT_CACHE", "default")
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books = create_books("apple pie", "apple juice", "pear", index=BookIndexEntry)
+
+    def search(self, query="apple"):
+        return [entry.object_id for entry in BookIndexEntry.objects.search(query)]
+
+    def test_cached(self):
+        expected = self.search()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.search(), expected)
+
+    def test_invalidated_on_save(self):
+        self.assertEqual(len(self.search()), 2)
+        generation = cache.get(generation_key(BookIndexEntry))
+        book = self.books[2]
+        book.body = "apple tart"
+        with self.captureOnCommitCallbacks(execute=True):
+            book.save()
+            BookIndexEntry.update_index(book)
+        self.assertNotEqual(cache.get(generation_key(BookIndexEntry)), generation)
+        self.assertIn(book.pk, self.search())
+
+    def test_invalidated_on_delete(self):
+        self.assertEqual(len(self.search()), 2)
+        generation = cache.get(generation_key(BookIndexEntry))
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.filter(pk=self.books[0].pk).delete()
+        self.assertNotEqual(cache.get(generation_key(BookIndexEntry)), generation)
+        self.assertEqual(self.search(), [self.books[1].pk])
+
+
+class CachedRankingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.books = create_books("apple pie", "pie with apple and more apple", "apple",
+                                      "an apple tart", "pear", index=BookIndexEntry)
+
+    def operations(self):
+        qs = BookIndexEntry.objects.search("apple pie")
+        rank = list(qs)[1].rank
+        return {
+            "iterate": [entry.pk for entry in qs],
+            "order_by": [entry.pk for entry in qs.order_by("-pk")],
+            "reverse": [entry.pk for entry in qs.reverse()],
+            "filter": [entry.pk for entry in qs.filter(object_id__gt=self.books[0].pk)
+                       .order_by("object_id")],
+            "slice": [entry.pk for entry in qs[1:3]],
+            "first": qs.first().pk,
+            "last": qs.last().pk,
+            "values_list": list(qs.values_list("pk", flat=True)),
+            "values_rank": list(qs.values_list("pk", "rank")),
+            "filter_rank": [entry.pk for entry in qs.filter(rank__gt=rank)],
+            "annotate": [(entry.pk, entry.double) for entry in qs.annotate(double=F("rank")*2)],
+            "iterator": [entry.pk for entry in qs.iterator()],
+            "facets": qs.facets("length"),
+            "filtered_facets": qs.filter(object_id__gt=self.books[0].pk).facets("length"),
+        }
+
+    def test_same_results(self):
+        expected = self.operations()
+        with mock.patch("django_native_search.cache.RESULT_CACHE", "default"):
+            self.operations()
+            with self.subTest("cache filled"):
+                self.assertIsNotNone(BookIndexEntry.objects.search("apple pie").ranking)
+            for name, results in self.operations().items():
+                with self.subTest(name):
+                    self.assertEqual(results, expected[name])
+
+    def searches(self, results, *fields):
+        occurrences = BookIndexEntry.occurrences.model._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            results.facets(*fields)
+        self.assertTrue(queries.captured_queries)
+        return len([query for query in queries.captured_queries if occurrences in query["sql"]])
+
+    def test_facets_searched_once(self):
+        self.assertEqual(self.searches(BookIndexEntry.objects.search("apple pie"), "length", "object"), 1)
+        with mock.patch("django_native_search.cache.RESULT_CACHE", "default"):
+            BookIndexEntry.objects.search("apple pie")
+            self.assertEqual(self.searches(BookIndexEntry.objects.search("apple pie"), "length", "object"), 0)
+
+    @mock.patch("django_native_search.cache.RESULT_CACHE", "default")
+    @mock.patch("django_native_search.manager.RESULT_CACHE_MAX_RESULTS", 2)
+    def test_too_many_results_ranked_once(self):
+        qs = BookIndexEntry.objects.search("apple")
+        self.assertIsNone(qs.ranking)
+        with mock.patch.object(SearchQuerySet, "values_list", side_effect=AssertionError):
+            qs = BookIndexEntry.objects.search("apple")
+        self.assertIsNone(qs.ranking)
+        self.assertEqual(len(qs), 4)
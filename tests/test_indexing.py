@@ -0,0 +1,157 @@
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase
+
+from django_native_search.manager import LexemManager
+from django_native_search.models import IndexStatistics, Lexem, LexemStatistics, get_index
+from tests.testapp.models import Book, BookIndexEntry, PairBookEntry, PostingBookEntry
+from tests.utils import create_books
+
+
+def snapshot():
+    through = BookIndexEntry.occurrences.model
+    occurrences = sorted(through.objects.values_list(
+        "bookindexentry__object", "lexem__surface", "position", "prefix"))
+    entries = sorted(BookIndexEntry.objects.values_list("object", "length", "digest"))
+    index = get_index(BookIndexEntry)
+    statistics = (IndexStatistics.objects.filter(index=index).values_list("documents", "length").first(),
+                  sorted(LexemStatistics.objects.filter(index=index).values_list("lexem__surface", "documents")))
+    return occurrences, entries, statistics
+
+
+class IncrementalReindexTests(TestCase):
+    def setUp(self):
+        self.books = create_books(
+            "the quick brown fox jumps over the lazy dog",
+            "an apple a day keeps the doctor away",
+            "red apple, green apple; and a pie",
+            index=BookIndexEntry)
+
+    def edit(self):
+        first, second, third = self.books
+        first.body = "the quick red fox jumps over the lazy cat"
+        second.body = "an apple a day keeps the doctor away. really"
+        for book in (first, second):
+            book.save()
+        BookIndexEntry.objects.refresh(Book.objects.all())
+        create_books("a brand new book", index=BookIndexEntry)
+        Book.objects.filter(pk=third.pk).delete()
+
+    def test_incremental_reindex_matches_rebuild(self):
+        self.edit()
+        incremental = snapshot()
+
+        BookIndexEntry.objects.all().delete()
+        BookIndexEntry.objects.rebuild()
+        self.assertEqual(snapshot(), incremental)
+
+    def test_unchanged_entries_are_skipped(self):
+        through = BookIndexEntry.occurrences.model
+        entry = BookIndexEntry.objects.get(object=self.books[2])
+        rows = list(through.objects.filter(bookindexentry=entry).values_list("pk", flat=True))
+
+        BookIndexEntry.objects.refresh([self.books[2]])
+        self.assertEqual(list(through.objects.filter(bookindexentry=entry).values_list("pk", flat=True)), rows)
+
+    def test_search_after_reindex(self):
+        self.edit()
+        results = BookIndexEntry.objects.search("cat")
+        self.assertEqual([entry.object_id for entry in results], [self.books[0].pk])
+        self.assertFalse(BookIndexEntry.objects.search("pie"))
+
+
+class PostingsTests(TestCase):
+    def test_update_matches_occurrences(self):
+        books = create_books("apple pie and apple tart", "pear pie", "apple juice", index=PostingBookEntry)
+        BookIndexEntry.objects.refresh(books)
+        books[1].body = "pear and apple pie"
+        books[1].save()
+        for index in (BookIndexEntry, PostingBookEntry):
+            index.objects.refresh(books)
+
+        for query in ("apple", "pie", "apple pie", '"apple pie"'):
+            with self.subTest(query=query):
+                self.assertEqual(
+                    [(entry.object_id, entry.rank) for entry in PostingBookEntry.objects.search(query)],
+                    [(entry.object_id, entry.rank) for entry in BookIndexEntry.objects.search(query)])
+
+
+class TokenizeTests(TestCase):
+    def test_whitespace_collapsed(self):
+        text = "a b,\tc  d\u00a0e\n \nf, g"
+        prefixes = [getattr(token, "prefix", " ") for token in BookIndexEntry.tokenize(text)]
+        self.assertEqual(prefixes, ["", " ", " ", " ", " ", " ", " "])
+        streamed = BookIndexEntry.tokenize_chunks([text[:5], text[5:]])
+        self.assertEqual([getattr(token, "prefix", " ") for token in streamed], prefixes)
+
+
+class StreamingTests(TestCase):
+    def test_template_rendered_in_chunks(self):
+        book, = create_books("apple <pie> & tart")
+        entry = BookIndexEntry(object=book)
+        chunks = list(entry.text_chunks())
+        self.assertNotIn("rendered_text", entry.__dict__)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), entry.rendered_text)
+
+
+class PairsTests(TestCase):
+    def pairs(self, entry):
+        words = list(PairBookEntry.occurrences.model.objects.filter(pairbookentry=entry)
+                     .order_by("position").values_list("position", "lexem"))
+        expected = [(position, lexem, following) for (position, lexem), (next_position, following)
+                    in zip(words, words[1:]) if next_position == position + 1]
+        stored = list(PairBookEntry.pairs.model.objects.filter(pairbookentry=entry)
+                      .order_by("position").values_list("position", "lexem", "following"))
+        return stored, expected
+
+    @mock.patch.object(PairBookEntry, "streaming", True, create=True)
+    def test_updated_in_windows(self):
+        book, = create_books(" ".join(f"w{i % 700}" for i in range(1200)), index=PairBookEntry)
+        entry = PairBookEntry.objects.get(object=book)
+        for body in (" ".join(f"w{i % 700}" for i in range(-1, 900)),
+                     " ".join(f"w{i % 300}" for i in range(600)) + " " + "x" * 300 + " w1 w2"):
+            with self.subTest(body=body[:10]):
+                book.body = body
+                book.save()
+                PairBookEntry.objects.refresh([book])
+                stored, expected = self.pairs(entry)
+                self.assertEqual(stored, expected)
+                PairBookEntry.objects.rebuild_pairs()
+                self.assertEqual(self.pairs(entry), (stored, expected))
+
+
+class GarbageCollectionTests(TestCase):
+    def test_lexem_collected_while_indexing(self):
+        book = create_books("apple pie", index=BookIndexEntry)[0]
+        Lexem.objects.resolve(["tart"])
+        resolve = LexemManager.resolve
+        calls = []
+
+        def resolve_and_collect(manager, surfaces):
+            lexems = resolve(manager, surfaces)
+            calls.append(surfaces)
+            if len(calls) == 1:
+                Lexem.objects.collect_garbage()
+            return lexems
+
+        book.body = "apple tart"
+        book.save()
+        # On SQLite the foreign keys are only checked with the PostgreSQL code path.
+        with mock.patch.object(LexemManager, "resolve", resolve_and_collect), \
+                mock.patch.object(connection, "vendor", "postgresql"):
+            BookIndexEntry.update_index(book)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([entry.object_id for entry in BookIndexEntry.objects.search("tart")], [book.pk])
+
+    def test_batch_referenced_since_scan_skipped(self):
+        book = create_books("apple pie", index=BookIndexEntry)[0]
+        tart, = Lexem.objects.resolve(["tart"]).values()
+        scanned = Lexem.objects.all()
+        # On SQLite the foreign keys are only checked with the PostgreSQL code path.
+        with mock.patch.object(LexemManager, "unreferenced", lambda manager: scanned), \
+                mock.patch.object(connection, "vendor", "postgresql"):
+            self.assertEqual(Lexem.objects.collect_garbage(batch_size=2), 1)
+        self.assertFalse(Lexem.objects.filter(pk=tart).exists())
+        self.assertEqual([entry.object_id for entry in BookIndexEntry.objects.search("apple pie")], [book.pk])
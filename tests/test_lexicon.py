@@ -0,0 +1,43 @@
+import tempfile
+from unittest import mock
+
+from django.test import TestCase
+
+from django_native_search.lexicon import Lexicon, build_lexicon, lexicon_path, lexicons, read_lexems
+from django_native_search.models import Lexem
+from tests.testapp.models import BookIndexEntry
+from tests.utils import create_books
+
+
+class LexiconTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for patcher in (mock.patch("django_native_search.lexicon.LEXICON_PATH", f"{directory.name}/{{database}}.bin"),
+                        mock.patch.dict(lexicons)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def resolve(self, surface):
+        lexicon = Lexicon(lexicon_path(None))
+        return lexicon.resolve([("surface__exact", surface)])
+
+    def test_lexems_committed_out_of_order(self):
+        Lexem.objects.resolve(["late"])
+        Lexem.objects.resolve(["apple"])
+        late = Lexem.objects.get(surface="late")
+        Lexem.objects.filter(pk=late.pk).delete()
+        build_lexicon()
+        # Committed after the snapshot under an id below its last one.
+        late.save(force_insert=True)
+        self.assertLess(late.pk, Lexem.objects.get(surface="apple").pk)
+        self.assertEqual(self.resolve("late"), [late.pk])
+        build_lexicon()
+        self.assertIn((late.pk, "late", late.normalized), read_lexems(lexicon_path(None))[0])
+
+    def test_miss_resolved_by_database(self):
+        create_books("apple pie", index=BookIndexEntry)
+        build_lexicon()
+        self.assertIsNone(self.resolve("cake"))
+        self.assertEqual(self.resolve("apple"), [Lexem.objects.get(surface="apple").pk])
+        self.assertFalse(BookIndexEntry.objects.search("cake"))
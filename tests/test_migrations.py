@@ -0,0 +1,60 @@
+from django.apps import apps
+from django.db import connection, migrations, models
+from django.db.migrations.state import ProjectState
+from django.test import TransactionTestCase
+
+from django_native_search.fields import OccurrencesField
+from django_native_search.migrations.operations import OccurrencesCompactPrefix
+from django_native_search.models import Lexem
+
+PREFIXES = [" ", ", ", "", " ~ ", ". "]
+
+
+class OccurrencesCompactPrefixTests(TransactionTestCase):
+    app_label = "testapp"
+
+    def setUp(self):
+        self.state = ProjectState.from_apps(apps)
+        self.create = migrations.CreateModel("PrefixEntry", [
+            ("id", models.AutoField(primary_key=True)),
+            ("length", models.PositiveIntegerField()),
+            ("occurrences", OccurrencesField(query_name="occurrence")),
+        ])
+        self.plain = self.apply(self.create, self.state)
+
+    def tearDown(self):
+        with connection.schema_editor() as editor:
+            editor.delete_model(self.plain.apps.get_model(self.app_label, "PrefixEntry"))
+
+    def apply(self, operation, state, backwards=False):
+        new_state = state.clone()
+        operation.state_forwards(self.app_label, new_state)
+        with connection.schema_editor() as editor:
+            if backwards:
+                operation.database_backwards(self.app_label, editor, new_state, state)
+            else:
+                operation.database_forwards(self.app_label, editor, state, new_state)
+        return new_state
+
+    def through(self, state):
+        model = state.apps.get_model(self.app_label, "PrefixEntry")
+        return model, model._meta.get_field("occurrences").remote_field.through
+
+    def test_forwards_and_backwards(self):
+        model, through = self.through(self.plain)
+        entry = model.objects.create(length=len(PREFIXES))
+        lexem = Lexem.objects.create(surface="word")
+        through.objects.bulk_create([through(prefixentry_id=entry.pk, lexem_id=lexem.pk, position=position,
+                                             prefix=prefix) for position, prefix in enumerate(PREFIXES)])
+
+        operation = OccurrencesCompactPrefix("prefixentry")
+        compact = self.apply(operation, self.plain)
+        _, through = self.through(compact)
+        self.assertEqual(
+            list(through.objects.order_by("position").values_list("prefix_code", "prefix_raw")),
+            [(0, None), (2, None), (1, None), (0, " ~ "), (3, None)])
+        self.assertEqual([occurrence.prefix for occurrence in through.objects.all()], PREFIXES)
+
+        self.apply(operation, self.plain, backwards=True)
+        _, through = self.through(self.plain)
+        self.assertEqual(list(through.objects.order_by("position").values_list("prefix", flat=True)), PREFIXES)
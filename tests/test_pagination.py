@@ -0,0 +1,51 @@
+from unittest import mock
+
+from django.core import signing
+from django.core.cache import cache
+from django.test import TestCase
+
+from django_native_search.manager import decode_cursor, encode_cursor
+from tests.testapp.models import BookIndexEntry
+from tests.utils import create_books
+
+
+class CursorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Equal ranks make the primary key decide the order within a page boundary.
+        create_books(*["apple pie"]*5, *["apple and pie"]*4, *["apple and a pie"]*3, index=BookIndexEntry)
+
+    def pages(self, query, size):
+        pages = []
+        cursor = None
+        while True:
+            page = BookIndexEntry.objects.search(query).page(size, cursor)
+            pages.append([entry.pk for entry in page])
+            cursor = page.next_cursor
+            if cursor is None:
+                return pages
+
+    def test_round_trip(self):
+        entry = BookIndexEntry.objects.search("apple pie")[0]
+        self.assertEqual(decode_cursor(encode_cursor(entry)), [entry.rank, entry.pk])
+
+    def test_tampered_cursor(self):
+        cursor = encode_cursor(BookIndexEntry.objects.search("apple pie")[0])
+        with self.assertRaises(signing.BadSignature):
+            BookIndexEntry.objects.search("apple pie").page(2, cursor[:-1]+"x")
+
+    def test_pages_cover_results(self):
+        expected = [entry.pk for entry in BookIndexEntry.objects.search("apple pie")]
+        self.assertEqual(len(expected), 12)
+        for size in (1, 4, 5, 12, 20):
+            with self.subTest(size=size):
+                pages = self.pages("apple pie", size)
+                self.assertEqual(sum(pages, []), expected)
+                self.assertTrue(all(len(page)==size for page in pages[:-1]))
+
+    def test_pages_of_cached_ranking(self):
+        expected = [entry.pk for entry in BookIndexEntry.objects.search("apple pie")]
+        cache.clear()
+        with mock.patch("django_native_search.cache.RESULT_CACHE", "default"):
+            self.pages("apple pie", 5)
+            self.assertEqual(sum(self.pages("apple pie", 5), []), expected)
@@ -0,0 +1,48 @@
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from django_native_search.manager import IndexEntryManager
+from django_native_search.models import IndexRequest
+from tests.testapp.models import BookIndexEntry
+from tests.utils import create_books
+
+
+class IndexQueueTests(TestCase):
+    def setUp(self):
+        self.books = create_books("apple pie", "pear tart")
+        BookIndexEntry.objects.enqueue(self.books)
+
+    def test_processed(self):
+        self.assertEqual(IndexRequest.objects.process(), 2)
+        self.assertFalse(IndexRequest.objects.exists())
+        self.assertEqual(BookIndexEntry.objects.count(), 2)
+
+    def test_failed_requests_kept(self):
+        prepare = IndexEntryManager.get_or_prepare
+
+        def get_or_prepare(manager, obj):
+            if obj.pk == self.books[1].pk:
+                raise ValueError("Cannot render")
+            return prepare(manager, obj)
+
+        with mock.patch.object(IndexEntryManager, "get_or_prepare", get_or_prepare), \
+                self.assertLogs("django_native_search.manager", "WARNING"):
+            self.assertEqual(IndexRequest.objects.process(), 2)
+        request, = IndexRequest.objects.all()
+        self.assertEqual(request.object_id, str(self.books[1].pk))
+        self.assertGreater(request.requested, timezone.now())
+        self.assertEqual(IndexRequest.objects.process(), 0)
+
+    def test_requested_again_while_indexing(self):
+        save = BookIndexEntry.save
+
+        def enqueue_and_save(entry, *args, **kwargs):
+            BookIndexEntry.objects.enqueue([entry.object])
+            return save(entry, *args, **kwargs)
+
+        with mock.patch.object(BookIndexEntry, "save", enqueue_and_save):
+            IndexRequest.objects.process()
+        self.assertEqual(IndexRequest.objects.count(), 2)
+        self.assertEqual(IndexRequest.objects.process(), 2)
@@ -0,0 +1,116 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+
+from django_native_search.models import IndexStatistics, LexemStatistics
+from tests.testapp.models import BookIndexEntry, PairBookEntry, PostingBookEntry
+from tests.utils import create_books
+
+
+class QueryPlanningTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = create_books(
+            "quick dog runs home",
+            "dog quick runs home",
+            "the quick brown fox and a red dog",
+            "quick quick quick fox",
+            "quick brown fox",
+            "a quick red fox jumps over the brown dog",
+            index=BookIndexEntry)
+
+    def ranking(self, query, rank_by=None):
+        return [(entry.object_id, entry.rank) for entry in BookIndexEntry.objects.search(query, rank_by)]
+
+    def test_plan_puts_rare_keyword_first(self):
+        plan = BookIndexEntry.objects.search("quick dog").search_plan
+        self.assertEqual([token for token, _ in plan], ["dog", "quick"])
+
+    @mock.patch("django_native_search.statistics.PLAN_COUNT_LIMIT", 2)
+    def test_estimates_capped_without_statistics(self):
+        IndexStatistics.objects.all().delete()
+        plan = BookIndexEntry.objects.search("quick dog").search_plan
+        self.assertEqual(sorted(plan), [("dog", 2), ("quick", 2)])
+
+    def test_ranking_follows_query_order(self):
+        ranking = self.ranking("quick dog")
+        self.assertEqual(ranking[0][0], self.books[0].pk)
+        self.assertLess(ranking[0][1], dict(ranking)[self.books[1].pk])
+        self.assertEqual(self.ranking("dog quick")[0][0], self.books[1].pk)
+
+    def test_ranking_same_with_and_without_planning(self):
+        queries = ["quick dog", "dog quick", "fox brown quick", 'quick "brown fox" dog',
+                   'quick "red fox" jumps over brown']
+        for rank_by in ("proximity", "bm25"):
+            for query in queries:
+                with self.subTest(query=query, rank_by=rank_by):
+                    planned = self.ranking(query, rank_by)
+                    with mock.patch("django_native_search.manager.PLAN_QUERIES", False):
+                        self.assertEqual(planned, self.ranking(query, rank_by))
+
+    def test_rarest_keywords_ranked(self):
+        self.assertEqual(self.ranking("quick red dog"), self.ranking("red dog"))
+        PostingBookEntry.objects.refresh(self.books)
+        self.assertEqual([(entry.object_id, entry.rank) for entry in PostingBookEntry.objects.search("quick red dog")],
+                         self.ranking("red dog"))
+        with mock.patch("django_native_search.manager.PLAN_QUERIES", False):
+            self.assertEqual(self.ranking("quick red dog"), self.ranking("quick red"))
+
+
+class PhrasePairsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        bodies = [f"word{i} red apple pie z y" if i % 2 else f"red apple word{i} pie" for i in range(300)]
+        cls.books = create_books(*bodies, index=BookIndexEntry)
+        PairBookEntry.objects.refresh(cls.books)
+
+    def test_phrases_over_large_match_set(self):
+        params = []
+
+        def record(execute, sql, query_params, many, context):
+            params.append(len(query_params or ()))
+            return execute(sql, query_params, many, context)
+
+        for query in ('"red apple"', '"red apple" pie', '"red apple" pie z y', 'pie "apple pie z" y'):
+            with self.subTest(query=query):
+                params.clear()
+                with connection.execute_wrapper(record):
+                    results = [(entry.object_id, entry.rank) for entry in PairBookEntry.objects.search(query)]
+                    count = PairBookEntry.objects.search(query).count()
+                self.assertLess(max(params), len(self.books))
+                self.assertEqual(results, [(entry.object_id, entry.rank)
+                                           for entry in BookIndexEntry.objects.search(query)])
+                self.assertEqual(count, BookIndexEntry.objects.search(query).count())
+
+
+@mock.patch("django_native_search.manager.EXACT_COUNT_LIMIT", 3)
+class CountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_books(*[f"apple pie {i}" if i % 2 else f"apple juice {i}" for i in range(20)], index=BookIndexEntry)
+
+    def test_estimated(self):
+        count = BookIndexEntry.objects.search("apple").count()
+        self.assertEqual((str(count), count.exact), ("~20", False))
+
+    def test_estimate_capped_by_entries(self):
+        IndexStatistics.objects.update(documents=100)
+        LexemStatistics.objects.update(documents=100)
+        self.assertEqual(str(BookIndexEntry.objects.search("apple").count()), "~20")
+
+    def test_filtered(self):
+        pies = BookIndexEntry.objects.filter(object__body__contains="pie")
+        self.assertEqual(str(pies.search("apple").count()), "3+")
+        self.assertEqual(str(BookIndexEntry.objects.search("apple").filter(object__body__contains="pie").count()), "3+")
+        self.assertEqual(BookIndexEntry.objects.filter(object__body__contains="pear").search("apple").count(), 0)
+
+    @mock.patch("django_native_search.cache.RESULT_CACHE", "default")
+    def test_filtered_cached_ranking(self):
+        cache.clear()
+        BookIndexEntry.objects.search("apple").count()
+        results = BookIndexEntry.objects.search("apple")
+        self.assertIsNotNone(results.ranking)
+        self.assertEqual(str(results.count()), "20")
+        self.assertEqual(str(results.filter(object__body__contains="pie").count()), "3+")
@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from django_native_search.models import Lexem
+from tests.testapp.models import Book, BookIndexEntry
+from tests.utils import create_books
+
+
+def in_thread(function):
+    def run():
+        try:
+            return function()
+        finally:
+            connection.close()
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(run).result()
+
+
+class OnlineRebuildTests(TransactionTestCase):
+    def setUp(self):
+        self.books = create_books("apple pie", "apple juice", "pear tart", index=BookIndexEntry)
+
+    def search(self, query):
+        return sorted(entry.object_id for entry in BookIndexEntry.objects.search(query))
+
+    def test_other_threads_use_live_tables(self):
+        seen = []
+
+        def edit():
+            book = Book.objects.get(pk=self.books[2].pk)
+            book.body = "apple cake"
+            book.save()
+            BookIndexEntry.update_index(book)
+            return self.search("apple")
+
+        def progress(stats):
+            seen.append((BookIndexEntry.objects.count(), in_thread(lambda: self.search("apple"))))
+            if len(seen) == 1:
+                seen.append(in_thread(edit))
+
+        BookIndexEntry.objects.rebuild(online=True, chunk_size=1, progress=progress).join()
+
+        first, second, third = (book.pk for book in self.books)
+        self.assertEqual(seen[:3], [(1, [first, second]), [first, second, third], (2, [first, second, third])])
+        self.assertEqual(self.search("apple"), [first, second, third])
+        self.assertEqual(self.search("cake"), [third])
+        self.assertEqual(BookIndexEntry.objects.count(), 3)
+
+    def test_lexems_of_shadow_tables_kept(self):
+        Book.objects.filter(pk=self.books[2].pk).update(body="quince tart")
+        collected = []
+
+        def progress(stats):
+            if stats.done == 3:
+                collected.append(in_thread(lambda: Lexem.objects.filter(surface="quince").exists()))
+                collected.append(in_thread(Lexem.objects.collect_garbage))
+
+        BookIndexEntry.objects.rebuild(online=True, chunk_size=1, progress=progress).join()
+        self.assertEqual(collected, [True, 0])
+        self.assertEqual(self.search("quince"), [self.books[2].pk])
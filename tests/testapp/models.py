@@ -0,0 +1,27 @@
+from django.db import models
+from django_native_search.fields import PairsField
+from django_native_search.models import IndexEntry
+
+
+class Book(models.Model):
+    title = models.CharField(max_length=255)
+    body = models.TextField()
+    updated = models.DateTimeField(auto_now=True)
+
+
+class BookIndexEntry(IndexEntry):
+    object = models.OneToOneField(Book, on_delete=models.CASCADE)
+    search_template = "search/book.txt"
+    modified_field = "updated"
+
+
+class PostingBookEntry(IndexEntry):
+    object = models.OneToOneField(Book, on_delete=models.CASCADE, related_name="posting_entry")
+    search_template = "search/book.txt"
+    storage = "postings"
+
+
+class PairBookEntry(IndexEntry):
+    object = models.OneToOneField(Book, on_delete=models.CASCADE, related_name="pair_entry")
+    search_template = "search/book.txt"
+    pairs = PairsField()
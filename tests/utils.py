@@ -0,0 +1,8 @@
+from tests.testapp.models import Book
+
+
+def create_books(*bodies, index=None):
+    books = [Book.objects.create(title=f"Book {i}", body=body) for i, body in enumerate(bodies)]
+    if index is not None:
+        index.objects.refresh(books)
+    return books